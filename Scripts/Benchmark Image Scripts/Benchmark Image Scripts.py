@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import tempfile
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import numpy as np
+import PIL
+from PIL import Image
+
+# Colors
+red = "\033[31m"
+green = "\033[32m"
+blue = "\033[34m"
+reset = "\033[0m"
+
+# Folder containing all the scripts (this script's parent folder)
+SCRIPTS_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Peak memory is measured with Watermark Photos' get_peak_rss, shared with the scripts' timing reports
+# (loaded directly, load_script would overwrite this harness's config.json)
+_watermark_spec = importlib.util.spec_from_file_location(
+    "watermark_photos", os.path.join(SCRIPTS_FOLDER, "Watermark Photos", "Watermark Photos.py"))
+watermark_photos = importlib.util.module_from_spec(_watermark_spec)
+_watermark_spec.loader.exec_module(watermark_photos)
+
+
+# Load config
+if not os.path.exists("config.json"):
+    print(f"{red}Config file config.json not found. Please create it with the necessary settings.{reset}")
+    sys.exit(1)
+with open("config.json", 'r') as f:
+    config = json.load(f).get("benchmark", {})
+    corpus_folder = os.path.abspath(config.get("corpus_folder", "corpus"))
+    seed = config.get("seed", 42)
+    sizes = config.get("sizes", {"small": [640, 480], "medium": [3000, 2000], "large": [8000, 6000],
+                                  "narrow": [200, 12000]})
+    images_per_size = config.get("images_per_size", 4)
+    scripts = config.get("scripts", {
+        "Optimize Photos": {},
+        "Watermark Photos": {},
+        "Image Dither": {},
+        "Image Dither (bayer)": {"script": "Image Dither", "config": {"algorithm": "bayer"}},
+        "Image Dither (floyd-steinberg)": {"script": "Image Dither", "config": {"algorithm": "floyd-steinberg"}},
+        "Image Dither (atkinson)": {"script": "Image Dither", "config": {"algorithm": "atkinson"}},
+        "Remove EXIF Data": {},
+    })
+    repeat = max(1, config.get("repeat", 1))
+    results_file = config.get("results", "results.json")
+    baseline_file = config.get("baseline", "baseline.json")
+    save_baseline = config.get("save_baseline", False)
+    watermark_font = config.get("watermark_font", "arial.ttf")
+
+# Allow generating and opening gigapixel corpus images
+Image.MAX_IMAGE_PIXELS = None
+
+# (extension, with EXIF, with alpha) for each image of a size, cycled so every size gets every kind
+VARIANTS = [
+    (".jpg", True, False),
+    (".png", False, True),
+    (".jpg", False, False),
+    (".png", True, False),
+]
+
+
+def human_readable_bytes(num_bytes):
+    """Return a human-readable string for bytes (GB/MB/KB/bytes)."""
+    for unit in ['bytes', 'KB', 'MB', 'GB', 'TB']:
+        if num_bytes < 1024.0 or unit == 'TB':
+            if unit == 'bytes':
+                return f"{num_bytes} {unit}"
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024.0
+    return f"{num_bytes:.1f} PB"
+
+
+# --- Corpus ---
+def corpus_spec():
+    """Everything the corpus depends on, so it's only regenerated when one of them changes."""
+    return {"version": 1, "seed": seed, "sizes": sizes, "images_per_size": images_per_size}
+
+
+def synthesize_image(width, height, rng, alpha):
+    """Generate a deterministic photo-like image: smooth color blobs plus fine grain."""
+    base = rng.integers(0, 256, size=(max(2, height // 64), max(2, width // 64), 3), dtype=np.uint8)
+    img = Image.fromarray(base).resize((width, height), Image.BICUBIC)
+    # Grain from a small tile keeps generation cheap for huge images
+    grain_tile = Image.fromarray(rng.integers(0, 256, size=(256, 256, 3), dtype=np.uint8))
+    grain = Image.new("RGB", (width, height))
+    for y in range(0, height, 256):
+        for x in range(0, width, 256):
+            grain.paste(grain_tile, (x, y))
+    img = Image.blend(img, grain, 0.08)
+    if alpha:
+        # Soft-edged transparent border
+        mask = Image.fromarray(rng.integers(0, 256, size=(max(2, height // 128), max(2, width // 128)), dtype=np.uint8))
+        img.putalpha(mask.resize((width, height), Image.BICUBIC))
+    return img
+
+
+def generate_corpus():
+    """Generate the synthetic corpus (unless an identical one already exists) and return its file paths."""
+    spec = corpus_spec()
+    spec_path = os.path.join(corpus_folder, "spec.json")
+    if os.path.exists(spec_path):
+        with open(spec_path, 'r') as spec_file:
+            if json.load(spec_file) == spec:
+                return list_corpus()
+        shutil.rmtree(corpus_folder)
+
+    print(f"{blue}Generating corpus in {corpus_folder}...{reset}")
+    os.makedirs(corpus_folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for size_name, (width, height) in sizes.items():
+        for i in range(images_per_size):
+            ext, with_exif, with_alpha = VARIANTS[i % len(VARIANTS)]
+            img = synthesize_image(width, height, rng, with_alpha)
+            kwargs = {}
+            if with_exif:
+                exif = Image.Exif()
+                exif[271] = "Benchmark"  # Make
+                exif[272] = "Synthetic"  # Model
+                exif[274] = 6  # Orientation: rotated 90°
+                kwargs['exif'] = exif.tobytes()
+            if ext == ".jpg":
+                kwargs['quality'] = 92
+            path = os.path.join(corpus_folder, f"{size_name}_{i}{ext}")
+            img.save(path, **kwargs)
+            print(f"{green}{os.path.basename(path)} ({width}x{height}) - {human_readable_bytes(os.path.getsize(path))}{reset}")
+
+    with open(spec_path, 'w') as spec_file:
+        json.dump(spec, spec_file, indent=2)
+    return list_corpus()
+
+
+def list_corpus():
+    """Return the sorted paths of the corpus images."""
+    return sorted(os.path.join(corpus_folder, name) for name in os.listdir(corpus_folder) if not name.endswith(".json"))
+
+
+def image_megapixels(path):
+    """Return an image's size in megapixels, read from its header."""
+    with Image.open(path) as img:
+        return img.width * img.height / 1e6
+
+
+# --- Benchmarks (each one runs in its own fresh process so peak memory is its own) ---
+def load_script(name, script_config):
+    """Import a script as a module, with a config.json written for it in the current directory."""
+    with open("config.json", 'w') as config_file:
+        json.dump(script_config, config_file)
+    path = os.path.join(SCRIPTS_FOLDER, name, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.lower().replace(' ', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def copy_inputs(paths, folder):
+    """Copy the inputs of a benchmark that modifies files in place, returning the copies' paths."""
+    os.makedirs(folder, exist_ok=True)
+    copies = []
+    for path in paths:
+        copy = os.path.join(folder, os.path.basename(path))
+        shutil.copyfile(path, copy)
+        copies.append(copy)
+    return copies
+
+
+def bench_optimize_photos(paths, workdir, options):
+    module = load_script("Optimize Photos", {"optimization": {
+        "original_folder": corpus_folder,
+        "optimized_folder": os.path.join(workdir, "optimized"),
+    }})
+    start = time.perf_counter()
+    output_bytes = 0
+    for path in paths:
+        optimized_path = os.path.join(workdir, "optimized", os.path.basename(path))
+        success, message, _, delta, _ = module.process_image(path, optimized_path)
+        if not success:
+            raise RuntimeError(message)
+        output_bytes += delta['total_optimized_bytes']
+    return time.perf_counter() - start, output_bytes
+
+
+def bench_watermark_photos(paths, workdir, options):
+    folder = os.path.join(workdir, "photos")
+    copies = copy_inputs(paths, folder)
+    module = load_script("Watermark Photos", {"watermark": {
+        "folder": folder,
+        "text": "Benchmark",
+        "font": {"family": watermark_font},
+    }})
+    start = time.perf_counter()
+    for path in copies:
+        _, success, error, _ = module.process_image(path)
+        if not success:
+            raise RuntimeError(error)
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(os.path.getsize(path) for path in copies)
+
+
+def bench_image_dither(paths, workdir, options):
+    module = load_script("Image Dither", {"dither": options.get("config", {})})
+    start = time.perf_counter()
+    output_bytes = 0
+    for path in paths:
+        with Image.open(path) as img:
+            result = module.dither_image(img)
+        buffer = BytesIO()
+        result.save(buffer, format="PNG")
+        output_bytes += buffer.tell()
+    return time.perf_counter() - start, output_bytes
+
+
+def bench_remove_exif_data(paths, workdir, options):
+    copies = copy_inputs(paths, os.path.join(workdir, "photos"))
+    module = load_script("Remove EXIF Data", {})
+    start = time.perf_counter()
+    for path in copies:
+        module.remove_exif(path)
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(os.path.getsize(path) for path in copies)
+
+
+BENCHMARKS = {
+    "Optimize Photos": bench_optimize_photos,
+    "Watermark Photos": bench_watermark_photos,
+    "Image Dither": bench_image_dither,
+    "Remove EXIF Data": bench_remove_exif_data,
+}
+
+
+def run_benchmark(name, paths, options):
+    """Run one benchmark in the current (fresh) process and return its raw measurements."""
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    os.chdir(workdir)
+    try:
+        elapsed, output_bytes = BENCHMARKS[options.get("script", name)](paths, workdir, options)
+        return {"seconds": elapsed, "output_bytes": output_bytes, "peak_rss": watermark_photos.get_peak_rss()}
+    finally:
+        os.chdir(SCRIPTS_FOLDER)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(result, baseline):
+    """Return a short "vs baseline" description of a result."""
+    if not baseline:
+        return ""
+    parts = []
+    if baseline.get("images_per_s"):
+        parts.append(f"{(result['images_per_s'] / baseline['images_per_s'] - 1) * 100:+.1f}% speed")
+    if result.get("peak_rss") and baseline.get("peak_rss"):
+        parts.append(f"{(result['peak_rss'] / baseline['peak_rss'] - 1) * 100:+.1f}% memory")
+    if baseline.get("output_bytes"):
+        parts.append(f"{(result['output_bytes'] / baseline['output_bytes'] - 1) * 100:+.1f}% output")
+    return f" ({', '.join(parts)} vs baseline)" if parts else ""
+
+
+if __name__ == "__main__":
+    corpus = generate_corpus()
+    megapixels = {path: image_megapixels(path) for path in corpus}
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f).get("results", {})
+
+    results = {}
+    # spawn: every benchmark starts from a clean process, so peak memory isn't inherited
+    context = multiprocessing.get_context("spawn")
+    for name, options in scripts.items():
+        if options.get("script", name) not in BENCHMARKS:
+            print(f"{red}Unknown script {name}, skipping it{reset}")
+            continue
+        max_megapixels = options.get("max_megapixels")
+        paths = [path for path in corpus if max_megapixels is None or megapixels[path] <= max_megapixels]
+        if not paths:
+            print(f"{red}{name}: no corpus images under {max_megapixels} MP, skipping it{reset}")
+            continue
+
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as ex:
+                try:
+                    runs.append(ex.submit(run_benchmark, name, paths, options).result())
+                except Exception as e:
+                    print(f"{red}{name}: failed: {e}{reset}")
+                    break
+        if len(runs) < repeat:
+            continue
+
+        # Best of the repeats is the least noisy estimate
+        best = min(runs, key=lambda run: run["seconds"])
+        total_megapixels = sum(megapixels[path] for path in paths)
+        result = {
+            "images": len(paths),
+            "megapixels": total_megapixels,
+            "seconds": best["seconds"],
+            "images_per_s": len(paths) / best["seconds"],
+            "megapixels_per_s": total_megapixels / best["seconds"],
+            "peak_rss": max((run["peak_rss"] or 0) for run in runs) or None,
+            "output_bytes": best["output_bytes"],
+        }
+        results[name] = result
+        peak = human_readable_bytes(result['peak_rss']) if result['peak_rss'] else "n/a"
+        print(f"{green}{name}: {result['images_per_s']:.2f} images/s, {result['megapixels_per_s']:.1f} MP/s, "
+              f"peak {peak}, output {human_readable_bytes(result['output_bytes'])}"
+              f"{compare(result, baseline.get(name))}{reset}")
+
+    report = {
+        "corpus": corpus_spec(),
+        "corpus_hash": hashlib.sha1(json.dumps(corpus_spec(), sort_keys=True).encode("utf-8")).hexdigest(),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "numpy": np.__version__,
+        "machine": {"platform": platform.platform(), "cpus": os.cpu_count()},
+        "repeat": repeat,
+        "results": results,
+    }
+    with open(results_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"{blue}Results written to {results_file}{reset}")
+    if save_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"{blue}Results saved as the new baseline ({baseline_file}){reset}")
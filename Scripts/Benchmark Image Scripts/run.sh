@@ -0,0 +1,4 @@
+python "Benchmark Image Scripts.py"
+
+# Keep terminal window open
+read -n 1 -s -r -p "Press any key to exit..."
@@ -1,10 +1,170 @@
 # Adds a fake Discord ping to your inputted file (server icon)
 
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
-from PIL import ImageSequence
-
-
+from PIL import ImageChops
+from PIL import GifImagePlugin
+
+
+# Load config (optional, without it input.png/input.gif are used)
+config = {}
+if os.path.exists("config.json"):
+    with open("config.json", 'r') as f:
+        config = json.load(f).get("fake_ping", {})
+# A folder of icons to add the ping to (with its subdirectories), instead of input.png/input.gif
+folder = config.get("folder")
+output_folder = config.get("output_folder", "pinged")
+# Sizes (in pixels) to save every icon at, each icon is only decoded once for all of them. Empty keeps the icon's size
+sizes = config.get("sizes", [])
+workers = config.get("workers", "auto")
+if not isinstance(workers, int) or workers < 1:
+    workers = os.cpu_count() or 1
+
+# Loaded right away, so worker processes don't share the open file
 ping = Image.open("ping.png")
+ping.load()
+
+# How many frames (spread across the animation) the shared palette of a GIF is built from
+PALETTE_SAMPLE_FRAMES = 32
+# Size the sampled frames are scaled down to before building the palette
+PALETTE_SAMPLE_SIZE = 64
+# Palette index of transparent pixels in GIFs (the palette has 255 colors besides it)
+TRANSPARENT_INDEX = 255
+
+STATIC_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+# The ping resized to each size it's been needed at (in this process)
+_PING_CACHE = {}
+
+
+# The ping resized to a size, only resized the first time each size is needed
+def sized_ping(size):
+    if size not in _PING_CACHE:
+        _PING_CACHE[size] = ping.resize(size)
+    return _PING_CACHE[size]
+
+
+# Sizes to save an icon at: the configured sizes, or the icon's own size
+def output_sizes(icon_size):
+    return [(size, size) for size in sizes] or [icon_size]
+
+
+# Paths to save an icon at, one per output size (with the size added to the name when sizes are configured)
+def output_paths(path):
+    if not sizes:
+        return [path]
+    base, ext = os.path.splitext(path)
+    return [f"{base}_{size}{ext}" for size in sizes]
+
+
+# Resize an icon (or a frame) to a size and paste the ping on it, without changing the original
+def add_ping(icon, size):
+    icon = icon.resize(size) if icon.size != size else icon.copy()
+    icon.paste(sized_ping(size), (0, 0), sized_ping(size))
+    return icon
+
+
+# Add the ping to a static icon at every output size
+def ping_png(input_png, output_path):
+    if input_png.mode not in ("RGB", "RGBA"):
+        input_png = input_png.convert("RGBA")
+    for size, path in zip(output_sizes(input_png.size), output_paths(output_path)):
+        add_ping(input_png, size).save(path)
+
+
+# Build one palette for every frame of a GIF, from a few of its frames (with the ping) scaled down side by side.
+# Every frame is then mapped to it, instead of each one getting its own palette
+def shared_palette(input_gif):
+    step = max(1, input_gif.n_frames // PALETTE_SAMPLE_FRAMES)
+    samples = range(0, input_gif.n_frames, step)
+    sample = Image.new("RGB", (PALETTE_SAMPLE_SIZE * len(samples), PALETTE_SAMPLE_SIZE))
+    for i, index in enumerate(samples):
+        input_gif.seek(index)
+        frame = add_ping(input_gif.convert("RGBA"), input_gif.size).convert("RGB")
+        sample.paste(frame.resize((PALETTE_SAMPLE_SIZE, PALETTE_SAMPLE_SIZE)), (i * PALETTE_SAMPLE_SIZE, 0))
+    return sample.quantize(TRANSPARENT_INDEX, dither=Image.Dither.NONE)
+
+
+# Writes a GIF one frame at a time, all frames sharing the same palette.
+# Frames are whole (as Pillow composes them), so their original disposal still shows them right.
+# It's written to a temporary file that only replaces path once the GIF is complete
+class GifWriter:
+    def __init__(self, path, palette, loop):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.output = open(self.tmp_path, "wb")
+        self.palette = palette
+        # the GIF's color table, with room for the transparent index after the colors
+        self.colors = palette.getpalette()
+        self.colors += [0] * (3 * (TRANSPARENT_INDEX + 1) - len(self.colors))
+        self.loop = loop
+        self.previous = None
+        self.previous_disposal = None
+
+    # Add an RGBA frame
+    def write(self, frame, duration, disposal):
+        new_frame = frame.convert("RGB").quantize(palette=self.palette, dither=Image.Dither.NONE)
+        new_frame.putpalette(self.colors)
+        params = {"duration": duration, "disposal": disposal}
+        transparent = frame.getchannel("A").point(lambda alpha: 255 if alpha < 128 else 0)
+        if transparent.getbbox():
+            new_frame.paste(TRANSPARENT_INDEX, (0, 0) + new_frame.size, transparent)
+            params["transparency"] = TRANSPARENT_INDEX
+
+        if self.previous is None:
+            info = dict(params)
+            if self.loop is not None:
+                info["loop"] = self.loop
+            header, _ = GifImagePlugin.getheader(new_frame, info=info)
+            self.output.writelines(header)
+
+        # Only save the part that changed when the previous frame is left on screen
+        # (an unchanged frame still saves a pixel, to keep its duration)
+        bbox = (0, 0) + new_frame.size
+        if self.previous is not None and self.previous_disposal in (0, 1):
+            bbox = ImageChops.difference(self.previous, new_frame).getbbox() or (0, 0, 1, 1)
+        self.output.writelines(GifImagePlugin.getdata(new_frame.crop(bbox), bbox[:2], **params))
+        self.previous, self.previous_disposal = new_frame, disposal
+
+    # Finish the GIF and move it to its path
+    def close(self):
+        self.output.write(b";")
+        self.output.close()
+        os.replace(self.tmp_path, self.path)
+
+    # Delete the unfinished GIF (when something failed)
+    def discard(self):
+        self.output.close()
+        os.remove(self.tmp_path)
+
+
+# GIF disposal method to save the current frame of an animation with. GIFs keep their own, other animations
+# (WebP, APNG) are composed by Pillow into whole frames, which are cleared before the next one is shown
+def frame_disposal(animation):
+    return animation.disposal_method if animation.format == "GIF" else 2
+
+
+# Add the ping to an animated icon at every output size. Each frame is decoded once, then resized, pinged and
+# saved right away for every size, so only one frame is held at a time
+def ping_gif(input_gif, output_path):
+    palette = shared_palette(input_gif)
+    writers = []
+    try:
+        for size, path in zip(output_sizes(input_gif.size), output_paths(output_path)):
+            writers.append((size, GifWriter(path, palette, input_gif.info.get("loop"))))
+        for index in range(input_gif.n_frames):
+            input_gif.seek(index)
+            frame = input_gif.convert("RGBA")
+            for size, writer in writers:
+                writer.write(add_ping(frame, size), input_gif.info.get("duration", 0), frame_disposal(input_gif))
+    except BaseException:
+        for _, writer in writers:
+            writer.discard()
+        raise
+    for _, writer in writers:
+        writer.close()
 
 
 def png():
@@ -14,47 +174,75 @@ def png():
     except FileNotFoundError:
         return False
 
-    # Resize ping to same size as input
-    sized_ping = ping.resize(input_png.size)
-
-    # Paste the fake ping
-    input_png.paste(sized_ping, (0, 0), sized_ping)
-
-    # Save the new icon
-    input_png.save("output.png")
+    with input_png:
+        ping_png(input_png, "output.png")
 
     print("PNG | Fake ping added to input.png and saved as output.png")
     return True
 
 
 def gif():
-    # Get frames
+    # Get input
     try:
-        frames = [frame.copy() for frame in ImageSequence.Iterator(Image.open("input.gif"))]
+        input_gif = Image.open("input.gif")
     except FileNotFoundError:
         return False
 
-    # Resize ping to same size as frames
-    sized_ping = ping.resize(frames[0].size)
-
-    # Paste the fake ping in each frame
-    new_frames = []
-    for frame in frames:
-        frame = frame.convert("RGBA")
-        frame.paste(sized_ping, (0, 0), sized_ping)
-        new_frames.append(frame)
-
-    # Save the new icon
-    new_frames[0].save("output.gif", save_all=True, append_images=new_frames[1:])
+    with input_gif:
+        ping_gif(input_gif, "output.gif")
 
     print("GIF | Fake ping added to input.gif and saved as output.gif")
     return True
 
 
-# PNG
-if not png():
-    print("PNG | No input.png found")
-
-# GIF
-if not gif():
-    print("GIF | No input.gif found")
+# Resize the ping to every configured size up front, so workers don't each do it on their first icon
+def init_worker():
+    for size in sizes:
+        sized_ping((size, size))
+
+
+# Add the ping to an icon of the folder, saved in the same subdirectories of the output folder
+# (must be module-level for ProcessPoolExecutor)
+def process_icon(path):
+    output_path = os.path.join(output_folder, os.path.splitext(os.path.relpath(path, folder))[0])
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with Image.open(path) as icon:
+        if getattr(icon, "is_animated", False):
+            ping_gif(icon, output_path + ".gif")
+        else:
+            ping_png(icon, output_path + ".png")
+    return path
+
+
+# All icons in the folder and its subdirectories (except the output folder)
+def find_icons():
+    output = os.path.abspath(output_folder)
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != output]
+        for file in files:
+            if file.lower().endswith(STATIC_EXTS + (".gif",)):
+                yield os.path.join(root, file)
+
+
+if __name__ == "__main__":
+    if folder:
+        icons = list(find_icons())
+        print(f"Adding the fake ping to {len(icons)} icons from {folder} with {workers} workers...")
+        failed = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = {executor.submit(process_icon, icon): icon for icon in icons}
+            for future in as_completed(futures):
+                try:
+                    print(f"Fake ping added to {future.result()}")
+                except Exception as e:
+                    print(f"Failed to add the fake ping to {futures[future]}: {e}")
+                    failed += 1
+        print(f"Done, saved in {output_folder} ({failed} failed)")
+    else:
+        # PNG
+        if not png():
+            print("PNG | No input.png found")
+
+        # GIF
+        if not gif():
+            print("GIF | No input.gif found")
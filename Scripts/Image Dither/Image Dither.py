@@ -1,34 +1,499 @@
-from PIL import Image
+import os
+import sys
+import json
+import zlib
+import struct
+import tempfile
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
+from PIL import Image, ImageChops, GifImagePlugin, PngImagePlugin
 import numpy as np
 
-primary_color = [90, 230, 250, 255]
-secondary_color = [0, 0, 0, 255]
+# Colors
+red = "\033[31m"
+green = "\033[32m"
+blue = "\033[34m"
+reset = "\033[0m"
 
-img = Image.open('input.png')
-dither = np.random.default_rng(seed=42).integers(0, 256, size=(img.height, img.width))
-img = np.array(img).astype(int)
-new_img = np.copy(img)
-primary_color_three = primary_color[:3]
-secondary_color_three = secondary_color[:3]
+# Load config (optional, everything has a default)
+config = {}
+if os.path.exists("config.json"):
+    with open("config.json", 'r') as f:
+        config = json.load(f).get("dither", {})
+# An image, or a folder to dither every image in (with its subdirectories)
+input_path = config.get("input", "input.png")
+# The output file, or the folder the dithered images are saved in (with the same subdirectories)
+output_path = config.get("output", "dithered" if os.path.isdir(input_path) else "output")
+workers = config.get("workers", "auto")
+if not isinstance(workers, int) or workers < 1:
+    workers = os.cpu_count() or 1
+algorithm = config.get("algorithm", "random")
+bayer_size = config.get("bayer_size", 8)
+seed = config.get("seed", 42)
+primary_color = config.get("primary_color", [90, 230, 250, 255])
+secondary_color = config.get("secondary_color", [0, 0, 0, 255])
+# From darkest to brightest
+colors = config.get("colors", [secondary_color, primary_color])
 transparent = [0, 0, 0, 0]
+# Huge images (posters, scans) are read, dithered and written band by band (see dither_streamed)
+streaming = config.get("streaming", {})
+streaming_enabled = streaming.get("enabled", True)
+streaming_min_megapixels = streaming.get("min_megapixels", 100)
+streaming_band_rows = streaming.get("band_rows", "auto")
+streaming_memmap = streaming.get("memmap", True)
+# Where the memory-mapped scratch files go (None = the system's temp folder)
+streaming_scratch_folder = streaming.get("scratch_folder")
 
-for y in range(img.shape[0]): # loop thru y-values
-    for x in range(img.shape[1]): # loop thru x-values
-        pixel = img[y, x]
-        four_values = len(pixel) == 4
-        
-        if four_values and pixel[3] == 0:
-            new_img[y, x] = transparent
-            continue
-            
-        gray = (img[y, x, 0] + img[y, x, 1] + img[y, x, 2]) / 3  # grayscale (average)
-        dither_value = dither[y % dither.shape[0], x % dither.shape[1]]  # dither comparison value
-        
-        make_color = gray > dither_value
-        if four_values:
-            new_img[y, x] = primary_color if make_color else secondary_color
+# Allow processing intentionally large images — disables Pillow's decompression-bomb check
+Image.MAX_IMAGE_PIXELS = None
+
+# How many pixels to dither at once (the random thresholds and temporary arrays are only this big)
+STRIP_PIXELS = 1 << 20
+# Error diffusion steps once per diagonal of a strip, so it uses taller strips to take fewer steps
+DIFFUSION_STRIP_PIXELS = 1 << 22
+# Fewest rows diffused at once, even for images narrower than this
+MIN_DIFFUSION_ROWS = 64
+
+# Error diffusion kernels: (dx, dy, weight) of the neighbours the quantization error is spread to
+DIFFUSION_KERNELS = {
+    "floyd-steinberg": [(1, 0, 7 / 16), (-1, 1, 3 / 16), (0, 1, 5 / 16), (1, 1, 1 / 16)],
+    "atkinson": [(1, 0, 1 / 8), (2, 0, 1 / 8), (-1, 1, 1 / 8), (0, 1, 1 / 8), (1, 1, 1 / 8), (0, 2, 1 / 8)],
+}
+ALGORITHMS = ["random", "bayer", *DIFFUSION_KERNELS]
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tif", ".tiff", ".ppm", ".tga")
+
+# Raw (uncompressed) pixel layouts that can be memory-mapped: (bytes per pixel, channels to take in RGB(A) order)
+RAW_LAYOUTS = {
+    "RGB": (3, [0, 1, 2]),
+    "RGBA": (4, [0, 1, 2, 3]),
+    "RGBX": (4, [0, 1, 2]),
+    "BGR": (3, [2, 1, 0]),
+    "BGRA": (4, [2, 1, 0, 3]),
+    "BGRX": (4, [2, 1, 0]),
+}
+
+if algorithm not in ALGORITHMS:
+    print(f"{red}Unknown algorithm {algorithm}, the algorithms are: {', '.join(ALGORITHMS)}{reset}")
+    sys.exit(1)
+if bayer_size not in (2, 4, 8, 16):
+    print(f"{red}bayer_size must be 2, 4, 8 or 16{reset}")
+    sys.exit(1)
+if not 2 <= len(colors) <= 256:
+    print(f"{red}colors must have between 2 and 256 colors{reset}")
+    sys.exit(1)
+
+
+# Import one of the other scripts (next to this one) as a module, to use its code
+def load_sibling_script(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", name, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.lower().replace(' ', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Watermark Photos, whose PngBandReader and PngBandWriter read and write huge PNGs band by band.
+# Only loaded once an image is big enough to be streamed
+_WATERMARK_PHOTOS = None
+
+
+def watermark_photos():
+    global _WATERMARK_PHOTOS
+    if _WATERMARK_PHOTOS is None:
+        _WATERMARK_PHOTOS = load_sibling_script("Watermark Photos")
+    return _WATERMARK_PHOTOS
+
+
+# Bayer matrix of a size (power of 2), with the values 0 to size² - 1
+def bayer_matrix(size):
+    matrix = np.zeros((1, 1), dtype=np.uint16)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+
+# Threshold rows of a Bayer matrix tiled across the width, scaled to the 0-765 range of r + g + b
+def bayer_thresholds(width):
+    matrix = bayer_matrix(bayer_size)
+    thresholds = ((2 * matrix.astype(np.uint32) + 1) * 765) // (2 * bayer_size ** 2)
+    return np.tile(thresholds, (1, -(-width // bayer_size)))[:, :width].astype(np.uint16)
+
+
+# Palette color indexes of a strip for the threshold algorithms (random and bayer): r + g + b is placed between
+# the two nearest colors and the brighter one is used if the remainder is over the pixel's threshold
+def threshold_strip(strip, top, rng, thresholds):
+    gray = strip[..., 0].astype(np.uint16)
+    gray += strip[..., 1]
+    gray += strip[..., 2]
+    if rng is not None:
+        # uint32 draws give the same values as the default int64 ones, with half the memory
+        dither = rng.integers(0, 256, size=gray.shape, dtype=np.uint32).astype(np.uint16)
+        dither *= 3
+    else:
+        dither = thresholds
+
+    if len(colors) == 2:
+        base, remainder = 0, gray
+    else:
+        level = gray.astype(np.uint32) * (len(colors) - 1)
+        base = np.minimum(level // 765, len(colors) - 2).astype(np.uint8)
+        remainder = level - base * np.uint32(765)
+
+    brighter = np.empty(gray.shape, dtype=bool)
+    if rng is not None:
+        np.greater(remainder, dither, out=brighter)
+    else:
+        # compare each row against its row of the Bayer matrix, broadcast across the width
+        for row in range(bayer_size):
+            np.greater(remainder[row::bayer_size], dither[(top + row) % bayer_size], out=brighter[row::bayer_size])
+    return brighter if len(colors) == 2 else base + brighter
+
+
+# Palette color indexes of a strip for the error diffusion algorithms. carry holds the error spread to the
+# strip's first rows by the previous strip, and is updated with the error spread past its last rows.
+# Pixels are processed along diagonals: every pixel with the same x + 2y only gets error from pixels with a
+# smaller x + 2y, so a whole diagonal (one pixel from each row) is quantized with one vectorized operation.
+# The strip is stored skewed (skewed[x + 2y, y] = pixel) so every diagonal is a contiguous slice
+def diffuse_strip(strip, carry, kernel):
+    rows, width = strip.shape[:2]
+    extra = carry.shape[0]
+    step = 255 / (len(colors) - 1)
+    skewed = np.zeros((width + 2 * (rows + extra) + 4, rows + extra), dtype=np.float32)
+    for y in range(rows):
+        gray = strip[y, :, :3].sum(axis=1, dtype=np.float32) / 3
+        if y < extra:
+            gray += carry[y]
+        skewed[2 * y:2 * y + width, y] = gray
+    # error carried past the strip's last rows, when it's shorter than the carry
+    for y in range(rows, extra):
+        skewed[2 * y:2 * y + width, y] = carry[y]
+    offsets = [(dx + 2 * dy, dy, np.float32(weight)) for dx, dy, weight in kernel]
+
+    for k in range(width + 2 * (rows - 1)):
+        low = max(0, (k - width + 2) // 2)
+        high = min(rows, k // 2 + 1)
+        values = skewed[k, low:high]
+        level = np.rint(values / step)
+        np.clip(level, 0, len(colors) - 1, out=level)
+        error = values - level * step
+        # the diagonal is done, keep its color indexes in place
+        values[:] = level
+        for dk, dy, weight in offsets:
+            skewed[k + dk, low + dy:high + dy] += error * weight
+
+    indexes = np.empty((rows, width), dtype=np.uint8)
+    for y in range(rows):
+        indexes[y] = skewed[2 * y:2 * y + width, y]
+    for y in range(extra):
+        carry[y] = skewed[2 * (rows + y):2 * (rows + y) + width, rows + y]
+    return indexes
+
+
+# Dither an RGB/RGBA image given as strips of rows (arrays of the same width, from top to bottom),
+# yielding (first row, strip, palette color indexes) for each strip. The strips can have any height: the
+# random thresholds are drawn strip by strip from the same random stream (seeded so the output is
+# reproducible) and the diffused error is carried from strip to strip, so the result is the same
+def dither_strips(strips, width, seed):
+    rng = np.random.default_rng(seed=seed) if algorithm == "random" else None
+    thresholds = bayer_thresholds(width) if algorithm == "bayer" else None
+    kernel = DIFFUSION_KERNELS.get(algorithm)
+    if kernel:
+        carry = np.zeros((max(dy for _, dy, _ in kernel), width), dtype=np.float32)
+
+    top = 0
+    for strip in strips:
+        if kernel:
+            # diffuse_strip's skewed buffer grows with rows * (width + 2 * rows), so tall strips of
+            # narrow images are diffused a few rows at a time (the carry makes the result the same)
+            for part in split_rows(strip, diffusion_rows(width)):
+                yield top, part, diffuse_strip(part, carry, kernel)
+                top += len(part)
+        else:
+            yield top, strip, threshold_strip(strip, top, rng, thresholds)
+            top += len(strip)
+
+
+# Most rows error diffusion handles at once for an image of a width: no more than the width (or
+# MIN_DIFFUSION_ROWS for very narrow images), so diffuse_strip's buffer stays a few times the strip's size
+def diffusion_rows(width):
+    return min(max(1, DIFFUSION_STRIP_PIXELS // width), max(MIN_DIFFUSION_ROWS, width))
+
+
+# Height of the strips an image of a width is dithered in, so they have about STRIP_PIXELS pixels
+# (or DIFFUSION_STRIP_PIXELS for error diffusion, see diffusion_rows)
+def strip_rows(width):
+    if algorithm in DIFFUSION_KERNELS:
+        return diffusion_rows(width)
+    return max(1, STRIP_PIXELS // width)
+
+
+# Split an array of pixels into strips of (at most) rows rows
+def split_rows(pixels, rows):
+    for top in range(0, len(pixels), rows):
+        yield pixels[top:top + rows]
+
+
+# Palette of the colors as an array, with as many channels as the image (3 or 4)
+def color_palette(channels):
+    return np.array([(list(color) + [255])[:channels] for color in colors], dtype=np.uint8)
+
+
+# Write the colors of a dithered strip into out, keeping transparent pixels transparent
+def colorize(strip, indexes, palette, out):
+    np.take(palette, indexes, axis=0, out=out)
+    if strip.shape[2] == 4:
+        out[strip[..., 3] == 0] = transparent
+
+
+# Convert an image to RGB or RGBA (if it has transparency), the modes dithering works on
+def to_rgb(img):
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if img.has_transparency_data else "RGB")
+    return img
+
+
+# Dither an image with the configured algorithm and colors
+def dither_image(img, seed=seed):
+    img = to_rgb(img)
+    pixels = np.asarray(img)
+    palette = color_palette(pixels.shape[2])
+    new_img = np.empty_like(pixels)
+    for top, strip, indexes in dither_strips(split_rows(pixels, strip_rows(img.width)), img.width, seed):
+        colorize(strip, indexes, palette, new_img[top:top + len(strip)])
+    return Image.fromarray(new_img, img.mode)
+
+
+# Dither an image into a palette image (for GIFs): the palette is the colors, followed by a transparent
+# color if the image has transparency, so every frame of an animation shares the same palette
+def dither_palette_image(img, seed=seed):
+    img = to_rgb(img)
+    pixels = np.asarray(img)
+    if pixels.shape[2] == 4 and len(colors) == 256:
+        raise ValueError("GIFs with transparency can have at most 255 colors")
+    indexes = np.empty(pixels.shape[:2], dtype=np.uint8)
+    for top, strip, strip_indexes in dither_strips(split_rows(pixels, strip_rows(img.width)), img.width, seed):
+        out = indexes[top:top + len(strip)]
+        out[:] = strip_indexes
+        if pixels.shape[2] == 4:
+            out[strip[..., 3] == 0] = len(colors)
+    new_img = Image.fromarray(indexes, "P")
+    new_img.putpalette([value for color in colors for value in color[:3]] + [0, 0, 0])
+    return new_img
+
+
+# Save the frames of an animated GIF (or other non-PNG animation) one by one as they're dithered,
+# with their original durations, disposal methods and loop count
+def dither_gif(img, path):
+    loop = img.info.get("loop")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        for index in range(img.n_frames):
+            img.seek(index)
+            frame = dither_palette_image(img)
+            params = {"duration": img.info.get("duration", 0), "disposal": getattr(img, "disposal_method", 0)}
+            if img.mode == "RGBA" or img.has_transparency_data:
+                params["transparency"] = len(colors)
+            if index == 0:
+                header_info = dict(params)
+                if loop is not None:
+                    header_info["loop"] = loop
+                header, _ = GifImagePlugin.getheader(frame, info=header_info)
+                f.writelines(header)
+            f.writelines(GifImagePlugin.getdata(frame, **params))
+        f.write(b";")
+    os.replace(tmp_path, path)
+
+
+# Yield (type, data) of the chunks of an encoded PNG
+def png_chunks(data):
+    position = 8
+    while position < len(data):
+        length, kind = struct.unpack(">I4s", data[position:position + 8])
+        yield kind, data[position + 8:position + 8 + length]
+        position += 12 + length
+
+
+# Save the frames of an APNG one by one as they're dithered, with their original durations, disposal
+# operations and loop count. Frames are full canvases (as decoded by Pillow) so they replace the previous one
+def dither_apng(img, path):
+    default_image = img.info.get("default_image", False)
+    mode = None
+    sequence = 0
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(PngImagePlugin._MAGIC)
+        for index in range(img.n_frames):
+            img.seek(index)
+            frame = dither_image(img)
+            if mode is None:
+                mode = frame.mode
+            elif frame.mode != mode:
+                frame = frame.convert(mode)
+            buffer = BytesIO()
+            frame.save(buffer, format="PNG")
+            chunks = list(png_chunks(buffer.getvalue()))
+            if index == 0:
+                PngImagePlugin.putchunk(f, b"IHDR", chunks[0][1])
+                PngImagePlugin.putchunk(f, b"acTL", struct.pack(">II", img.n_frames - default_image, img.info.get("loop", 0)))
+            # the default image is shown by viewers without APNG support, and isn't part of the animation
+            if not (index == 0 and default_image):
+                duration = round(img.info.get("duration", 0))
+                PngImagePlugin.putchunk(f, b"fcTL", struct.pack(
+                    ">IIIIIHHBB", sequence, frame.width, frame.height, 0, 0, duration, 1000,
+                    img.info.get("disposal", 0), PngImagePlugin.Blend.OP_SOURCE))
+                sequence += 1
+            for kind, data in chunks:
+                if kind != b"IDAT":
+                    continue
+                if index == 0:
+                    PngImagePlugin.putchunk(f, b"IDAT", data)
+                else:
+                    PngImagePlugin.putchunk(f, b"fdAT", struct.pack(">I", sequence), data)
+                    sequence += 1
+        PngImagePlugin.putchunk(f, b"IEND", b"")
+    os.replace(tmp_path, path)
+
+
+# Memory-map the pixels of an uncompressed image (BMP, PPM, TGA, uncompressed TIFF...) straight from its file,
+# as an array of rows from top to bottom in RGB(A) order, or return None if its layout isn't supported
+def map_raw_pixels(img, source):
+    # tiles are (codec name, extents, offset, args), indexed as only recent Pillow versions name them
+    if len(img.tile) != 1 or img.tile[0][0] != "raw" or tuple(img.tile[0][1]) != (0, 0) + img.size:
+        return None
+    offset, args = img.tile[0][2], img.tile[0][3]
+    rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else args
+    if rawmode not in RAW_LAYOUTS:
+        return None
+    pixel_bytes, order = RAW_LAYOUTS[rawmode]
+    width, height = img.size
+    stride = stride or width * pixel_bytes
+    rows = np.memmap(source, dtype=np.uint8, mode='r', offset=offset, shape=(height, stride))
+    if orientation < 0:
+        rows = rows[::-1]
+    return rows[:, :width * pixel_bytes].reshape(height, width, pixel_bytes), order
+
+
+# Open an image file for streaming: returns (size, mode, iterator over RGB/RGBA strips of rows rows).
+# - 8-bit, non-interlaced PNGs are inflated one band at a time
+# - uncompressed images are memory-mapped and read in place (with memmap enabled)
+# - other formats can only be decoded whole by Pillow; with memmap enabled their pixels are moved to a
+#   memory-mapped scratch file and the decoded image freed, so the rest of the work only holds strips
+def open_strips(source, rows):
+    img = Image.open(source)
+    reader = None
+    # a transparent color (tRNS chunk) turns the image into RGBA, which the reader doesn't do
+    if img.format == "PNG" and "transparency" not in img.info:
+        try:
+            reader = watermark_photos().PngBandReader(source)
+        except ValueError:
+            pass
+    if reader is not None:
+        img.close()
+        mode = "RGBA" if reader.mode in ("LA", "RGBA") else "RGB"
+
+        def png_strips():
+            with reader:
+                for band in reader.bands(rows):
+                    yield np.asarray(band.convert(mode) if band.mode != mode else band)
+        return reader.size, mode, png_strips()
+
+    if streaming_memmap:
+        raw = map_raw_pixels(img, source)
+        if raw is not None:
+            pixels, order = raw
+            img.close()
+            return (pixels.shape[1], pixels.shape[0]), "RGBA" if len(order) == 4 else "RGB", (
+                strip[..., order] for strip in split_rows(pixels, rows))
+
+    img = to_rgb(img)
+    width, height = img.size
+    if not streaming_memmap:
+        return img.size, img.mode, split_rows(np.asarray(img), rows)
+    with tempfile.TemporaryFile(dir=streaming_scratch_folder) as scratch:
+        pixels = np.memmap(scratch, dtype=np.uint8, mode='w+', shape=(height, width, len(img.mode)))
+    for top in range(0, height, rows):
+        pixels[top:top + rows] = np.asarray(img.crop((0, top, width, min(height, top + rows))))
+    mode = img.mode
+    img.close()
+    return (width, height), mode, split_rows(pixels, rows)
+
+
+# Dither a huge image file into a PNG band by band: the source is read a strip at a time (see open_strips),
+# and every dithered strip is compressed and written before the next one is read, so memory stays bounded
+# whatever the image size. The output is the same as dither_image's
+def dither_streamed(source, path):
+    with Image.open(source) as img:
+        width = img.width
+    rows = streaming_band_rows if isinstance(streaming_band_rows, int) and streaming_band_rows > 0 else strip_rows(width)
+    size, mode, strips = open_strips(source, rows)
+    palette = color_palette(len(mode))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as out:
+        writer = watermark_photos().PngBandWriter(out, size, mode)
+        for _, strip, indexes in dither_strips(strips, size[0], seed):
+            band = np.empty((len(strip), size[0], len(mode)), dtype=np.uint8)
+            colorize(strip, indexes, palette, band)
+            writer.write(Image.fromarray(band, mode))
+        writer.close()
+    os.replace(tmp_path, path)
+
+
+# Dither an image file. Animations are dithered frame by frame, without ever holding all their frames,
+# and saved as GIFs (or APNGs for animated PNGs), other images are saved as PNGs.
+# path is the output path without its extension, returns the output path
+def dither_file(source, path):
+    with Image.open(source) as img:
+        if not getattr(img, "is_animated", False):
+            path += ".png"
+            if streaming_enabled and img.width * img.height >= streaming_min_megapixels * 1_000_000:
+                dither_streamed(source, path)
+            else:
+                dither_image(img).save(path)
+        elif img.format == "PNG":
+            path += ".png"
+            dither_apng(img, path)
         else:
-            new_img[y, x] = primary_color_three if make_color else secondary_color_three
+            path += ".gif"
+            dither_gif(img, path)
+    return path
+
+
+# Yield the paths of all images in a folder and its subdirectories (except the output folder)
+def find_images(folder):
+    output = os.path.abspath(output_path)
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) != output]
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTS):
+                yield os.path.join(root, file)
+
+
+# Worker function for the batch mode (must be module-level for ProcessPoolExecutor)
+def process_image(source):
+    path = os.path.join(output_path, os.path.splitext(os.path.relpath(source, input_path))[0])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return dither_file(source, path)
+
+
+if __name__ == "__main__":
+    if not os.path.isdir(input_path):
+        print(f"{green}Saved {dither_file(input_path, os.path.splitext(output_path)[0])}{reset}")
+        sys.exit(0)
 
-#new_img = np.clip(new_img, 0, 255) # shouldnt be necessary since all values should be 0 or 255
-Image.fromarray(new_img.astype(np.uint8)).save('output.png')
+    # Batch mode: dither every image of the folder across processes
+    images = list(find_images(input_path))
+    print(f"{blue}Dithering {len(images)} images from {input_path} into {output_path} with {workers} workers...{reset}")
+    success = 0
+    fail = 0
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(process_image, source): source for source in images}
+        for future in as_completed(futures):
+            try:
+                print(f"{green}Saved {future.result()}")
+                success += 1
+            except Exception as e:
+                print(f"{red}Error processing {futures[future]}: {e}")
+                fail += 1
+    print(f"{blue}Dithered {success} images ({fail} failures){reset}")
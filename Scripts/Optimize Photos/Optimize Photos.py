@@ -1,13 +1,27 @@
 import os
 import sys
+import time
 import threading
 import json
+import math
 import shutil
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from PIL import Image, ImageOps
+import hashlib
+import importlib.util
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from PIL import Image, ImageOps, ImageChops, ImageStat
 
-# Parallel config
-max_workers = min(32, (os.cpu_count() or 1) * 4)  # tuned for IO-heavy work
+# fcntl (for reflinks) isn't available on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# NumPy is only needed for the SSIM quality search
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Visual bar length (characters inside the [....])
 BAR_LENGTH = 20
@@ -34,27 +48,131 @@ with open("config.json", 'r') as f:
     resizing_max_width = resizing.get("max_width", 4096)
     resizing_max_height = resizing.get("max_height", 3072)
     resizing_upscale = resizing.get("upscale", False)
+    resizing_fast_decode = resizing.get("fast_decode", False)
+    resizing_reducing_gap = resizing.get("reducing_gap", 2.0)
+    quality_search = config.get("quality_search", {})
+    quality_search_enabled = quality_search.get("enabled", False)
+    quality_search_mode = quality_search.get("mode", "ssim")
+    quality_search_target_ssim = quality_search.get("target_ssim", 0.97)
+    quality_search_target_bytes = quality_search.get("target_bytes", 500 * 1024)
+    quality_search_min_quality = quality_search.get("min_quality", 30)
+    quality_search_max_quality = quality_search.get("max_quality", 95)
+    quality_search_max_trials = max(1, quality_search.get("max_trials", 6))
+    output_format = config.get("output_format", {})
+    output_format_target = output_format.get("format", "original").lower()
+    output_format_keep_smaller = output_format.get("keep_smaller", True)
+    output_webp = output_format.get("webp", {})
+    output_avif = output_format.get("avif", {})
+    png = config.get("png", {})
+    png_enabled = png.get("enabled", False)
+    png_palette = png.get("palette", True)
+    png_lossy = png.get("lossy", False)
+    png_lossy_colors = png.get("lossy_colors", 256)
+    png_lossy_min_psnr = png.get("lossy_min_psnr", 40)
+    png_strategies = png.get("strategies", ["default", "filtered", "rle"])
+    png_parallel_trials = png.get("parallel_trials", True)
+    keep_original = config.get("keep_original", {})
+    keep_original_enabled = keep_original.get("enabled", False)
+    keep_original_min_saving_percent = keep_original.get("min_saving_percent", 2)
+    keep_original_method = keep_original.get("method", "copy")
+    instrumentation = config.get("instrumentation", {})
+    instrumentation_enabled = instrumentation.get("enabled", False)
+    instrumentation_report = instrumentation.get("report", "optimize_report.json")
+    incremental = config.get("incremental", {})
+    incremental_enabled = incremental.get("enabled", False)
+    incremental_manifest = incremental.get("manifest", ".optimize_manifest.json")
+    parallel = config.get("parallel", {})
+    parallel_backend = parallel.get("backend", "thread")
+    parallel_workers = parallel.get("workers", "auto")
+    parallel_chunk_size = max(1, parallel.get("chunk_size", 4))
+    parallel_memory_per_worker_mb = parallel.get("memory_per_worker_mb", 512)
+    parallel_memory_budget_mb = parallel.get("memory_budget_mb", "auto")
+    parallel_streaming = parallel.get("streaming", False)
+    pipeline = config.get("pipeline", {})
+    pipeline_stages = pipeline.get("stages", ["orient", "resize"])
 
-# Delete existing optimized_folder
-if os.path.exists(optimized_folder):
-    try:
-        shutil.rmtree(optimized_folder)
-    except Exception as e:
-        print(f"{red}Failed to remove optimized folder {optimized_folder}: {e}{reset}")
-
-# Stats (thread-safe updates)
-stats_lock = threading.Lock()
+# Stats (only updated from the main thread/process, workers return their share with each result)
 stats = {
     'success': 0,
     'fail': 0,
     'resized': 0,
     'processed': 0,
+    'skipped': 0,
+    'pruned': 0,
     'total_original_bytes': 0,
     'total_optimized_bytes': 0,
+    'total_pixels': 0,
+    'searched': 0,
+    'searched_bytes': 0,
+    'fixed_quality_bytes': 0,
+    'kept_original': 0,
+    'kept_original_encoded_bytes': 0,
 }
 
+if quality_search_enabled and quality_search_mode == "ssim" and np is None:
+    print(f"{red}The SSIM quality search needs NumPy (pip install numpy), use \"mode\": \"bytes\" or install it{reset}")
+    sys.exit(1)
+
 VALID_EXTS = (".jpg", ".jpeg", ".tiff", ".png")
 
+# Stages the pipeline can run between decoding and encoding an image
+PIPELINE_STAGES = ("orient", "strip_metadata", "resize", "watermark")
+unknown_stages = [stage for stage in pipeline_stages if stage not in PIPELINE_STAGES]
+if unknown_stages:
+    print(f"{red}Unknown pipeline stages {unknown_stages}, the stages are: {', '.join(PIPELINE_STAGES)}{reset}")
+    sys.exit(1)
+
+# Resize sizes are computed on the oriented size when images are oriented before being resized
+orient_before_resize = "orient" in pipeline_stages and (
+    "resize" not in pipeline_stages or pipeline_stages.index("orient") < pipeline_stages.index("resize"))
+# Keeping an original would skip the stages that change its content
+pipeline_modifies = "strip_metadata" in pipeline_stages or "watermark" in pipeline_stages
+
+
+def load_sibling_script(name):
+    """Import one of the other photo scripts (next to this one) as a module, to use it as a pipeline stage.
+
+    It reads its own section of the same config.json (e.g. "watermark" for Watermark Photos).
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", name, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.lower().replace(' ', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+remove_exif_data = load_sibling_script("Remove EXIF Data") if "strip_metadata" in pipeline_stages else None
+# Watermark Photos is the "watermark" stage, and also holds the helpers the photo scripts share.
+# Loading it lifts Pillow's decompression bomb limit, which is kept unless watermarking
+max_image_pixels = Image.MAX_IMAGE_PIXELS
+watermark_photos = load_sibling_script("Watermark Photos")
+if "watermark" not in pipeline_stages:
+    Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+# zlib strategies the PNG engine can try (values of zlib.Z_DEFAULT_STRATEGY, Z_FILTERED, ...)
+PNG_STRATEGIES = {"default": 0, "filtered": 1, "huffman": 2, "rle": 3, "fixed": 4}
+
+# ioctl request to clone a file's extents (copy-on-write copy) on Linux (Btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Formats images can be converted to (AVIF needs a Pillow build with AVIF support)
+OUTPUT_FORMATS = {"webp": ("WEBP", ".webp"), "avif": ("AVIF", ".avif")}
+if output_format_target == "original":
+    output_format_target = None
+Image.init()
+output_format_supported = output_format_target in OUTPUT_FORMATS and OUTPUT_FORMATS[output_format_target][0] in Image.SAVE
+
+# SSIM is computed at full resolution (downscaling would average away JPEG's 8x8 block artifacts),
+# on at most this many pixels per image: big images are sampled with tiles spread over them
+SSIM_MAX_PIXELS = 1 << 20
+# Side of the sampled tiles
+SSIM_TILE = 256
+# Side of the square SSIM window
+SSIM_WINDOW = 7
+
+# Decoded copies alive at once per image (decoded, EXIF-transposed and converted/resized copy)
+DECODE_OVERHEAD = 3
+
 # Determine resampling filter in a backward/forward-compatible way
 RESAMPLE = None
 resampling_attr = getattr(Image, 'Resampling', None)
@@ -75,12 +193,223 @@ def human_readable_bytes(num_bytes):
     return f"{num_bytes:.1f} PB"
 
 
-def print_progress_bar(current, total, bar_length=BAR_LENGTH):
+def load_manifest(path):
+    """Load the incremental manifest (relative source path -> entry), or an empty one."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as manifest_file:
+            return json.load(manifest_file).get("files", {})
+    except Exception as e:
+        print(f"{red}Failed to read manifest {path}, rebuilding it: {e}{reset}")
+        return {}
+
+
+def save_manifest(path, entries):
+    """Atomically write the incremental manifest so an interrupted run never corrupts it."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump({"version": 1, "files": entries}, manifest_file, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Return the SHA-1 hex digest of a file's contents."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def compute_target_size(width, height):
+    """Return the (width, height) an image of the given size will be resized to, or None if it won't be."""
+    if not resizing_enabled:
+        return None
+    if not resizing_upscale and width <= resizing_max_width and height <= resizing_max_height:
+        return None
+    ratio = min(resizing_max_width / width, resizing_max_height / height)
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+
+def thumbnail_size(width, height, box):
+    """Return the size Image.thumbnail would produce for a (width, height) image fit into box.
+
+    Mirrors Pillow's aspect-preserving rounding (and that it never upscales), so the fast decode
+    path produces exactly the same dimensions as the full decode path.
+    """
+    x, y = box
+    if x >= width and y >= height:
+        return width, height
+    aspect = width / height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+
+def config_fingerprint(ext, width, height):
+    """Fingerprint of the settings that affect the output of one image.
+
+    Only settings that actually change this file's output are included (e.g. quality is ignored
+    for PNGs, and max dimensions only matter through the final size), so a config change only
+    invalidates the manifest entries it affects.
+    """
+    target_size = compute_target_size(width, height)
+    settings = {'ext': ext, 'size': target_size or (width, height)}
+    if ext in ('.jpg', '.jpeg'):
+        settings['quality'] = quality
+        if quality_search_enabled:
+            settings['quality_search'] = quality_search
+        if target_size is not None and resizing_fast_decode:
+            settings['fast_decode'] = resizing_reducing_gap
+    if ext == '.png' and png_enabled:
+        settings['png'] = png
+    if output_format_supported:
+        settings['output_format'] = output_format
+    if keep_original_enabled:
+        settings['keep_original'] = keep_original
+    if pipeline_stages != ["orient", "resize"]:
+        settings['pipeline'] = pipeline_stages
+    if "watermark" in pipeline_stages:
+        settings['watermark'] = watermark_photos.config
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def converted_path(optimized_path):
+    """Return the path an image is written to when converted to the configured output format."""
+    return os.path.splitext(optimized_path)[0] + OUTPUT_FORMATS[output_format_target][1]
+
+
+def output_candidates(optimized_path):
+    """Return every path an image's output can end up at (the original format and the converted one)."""
+    if output_format_supported:
+        return [optimized_path, converted_path(optimized_path)]
+    return [optimized_path]
+
+
+def entry_output(entry, optimized_path):
+    """Return the path of the output recorded in a manifest entry."""
+    if entry.get('output'):
+        return os.path.join(optimized_folder, entry['output'])
+    return optimized_path
+
+
+def is_unchanged(entry, file_stat, optimized_path):
+    """Cheap (stat-only) check whether a manifest entry still matches the source and config."""
+    if not entry or not os.path.exists(entry_output(entry, optimized_path)):
+        return False
+    if entry.get('size') != file_stat.st_size or entry.get('mtime_ns') != file_stat.st_mtime_ns:
+        return False
+    ext = os.path.splitext(optimized_path)[1].lower()
+    return entry.get('fingerprint') == config_fingerprint(ext, entry.get('width', 0), entry.get('height', 0))
+
+
+def build_task(original_path, manifest, new_manifest, expected_outputs):
+    """Return the (original_path, optimized_path, entry) task for an image, or None if it's unchanged."""
+    relative_path = os.path.relpath(original_path, original_folder)
+    optimized_path = os.path.join(optimized_folder, relative_path)
+    if not incremental_enabled:
+        return original_path, optimized_path, None
+    for candidate in output_candidates(optimized_path):
+        expected_outputs.add(os.path.normpath(candidate))
+    entry = manifest.get(relative_path)
+    try:
+        if is_unchanged(entry, os.stat(original_path), optimized_path):
+            new_manifest[relative_path] = entry
+            return None
+    except OSError:
+        pass
+    return original_path, optimized_path, entry
+
+
+def chunked(tasks, size):
+    """Group an iterable of tasks into lists of up to size tasks, without materializing it."""
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def prune_outputs(manifest, expected_outputs):
+    """Delete the outputs recorded in the previous run's manifest that this run no longer produces
+    (their source was deleted or renamed), then remove the folders they leave empty.
+
+    Only files this script wrote are deleted: anything else in optimized_folder (e.g. Watermark
+    Photos' journal when it's run on the optimized photos) is left alone.
+    """
+    pruned = 0
+    root = os.path.normpath(optimized_folder)
+    for relative_path, entry in manifest.items():
+        path = os.path.normpath(entry_output(entry, os.path.join(optimized_folder, relative_path)))
+        if path in expected_outputs or not os.path.isfile(path):
+            continue
+        try:
+            os.remove(path)
+            pruned += 1
+        except Exception as e:
+            print(f"{red}Failed to remove stale output {path}: {e}{reset}")
+            continue
+        folder = os.path.dirname(path)
+        while folder != root and folder.startswith(root + os.sep) and not os.listdir(folder):
+            try:
+                os.rmdir(folder)
+            except Exception:
+                break
+            folder = os.path.dirname(folder)
+    return pruned
+
+
+def pick_worker_count(backend):
+    """Pick the number of workers from the config, the core count and the available memory."""
+    if isinstance(parallel_workers, int) and parallel_workers > 0:
+        return parallel_workers
+    cpu = os.cpu_count() or 1
+    # Threads still overlap file IO with the GIL-releasing parts of Pillow, processes are CPU-bound
+    workers = min(32, cpu * 4) if backend == "thread" else cpu
+    # Every worker holds at least one full-resolution decode in memory, keep them all in RAM
+    available = watermark_photos.get_available_memory()
+    if available and parallel_memory_per_worker_mb > 0:
+        workers = min(workers, available // (parallel_memory_per_worker_mb * 1024 * 1024))
+    return max(1, int(workers))
+
+
+def estimate_decoded_bytes(path):
+    """Estimate the memory needed to process an image from its header only (width x height x bands)."""
+    try:
+        with Image.open(path) as img:
+            return img.width * img.height * len(img.getbands()) * DECODE_OVERHEAD
+    except Exception:
+        # Unreadable images fail fast in the worker, they don't need any budget
+        return 0
+
+
+def init_worker():
+    """Per-process worker initialization: register all Pillow plugins once up front."""
+    Image.init()
+
+
+def process_chunk(tasks):
+    """Process a chunk of (original_path, optimized_path, entry) tasks in one worker call."""
+    return [process_image(o, p, e) for o, p, e in tasks]
+
+
+def print_progress_bar(current, total, bar_length=BAR_LENGTH, total_known=True):
     """Return a fixed-width progress bar string (no newline).
 
     The returned string is exactly PROGRESS_COL_WIDTH characters (not counting color codes),
     so the caller can write one space and then the file message and the message will
-    always start in the same column.
+    always start in the same column. While files are still being discovered (total_known is
+    False), the total is the number found so far and is shown with a trailing '+'.
     """
     global PROGRESS_COL_WIDTH
     if PROGRESS_COL_WIDTH is None:
@@ -98,7 +427,7 @@ def print_progress_bar(current, total, bar_length=BAR_LENGTH):
         percent = int(round(frac * 100.0))  # no decimals per user request
         # build visible without trailing spaces so adding one single space later yields
         # exactly one space between progress and the file message
-        visible = f"[{bar}] {current}/{total} ({percent}%)"
+        visible = f"[{bar}] {current}/{total}{'' if total_known else '+'} ({percent}%)"
 
     # Pad/truncate the visible text to PROGRESS_COL_WIDTH (visible length only)
     if len(visible) < PROGRESS_COL_WIDTH:
@@ -109,87 +438,471 @@ def print_progress_bar(current, total, bar_length=BAR_LENGTH):
     return f"{blue}{padded}{reset}"
 
 
-def process_image(original_path, optimized_path):
-    """Process a single image: resize/optimize and return stats and a log message."""
+def encode_jpeg(img, jpeg_quality, exif_bytes=None):
+    """Encode an RGB image as an optimized JPEG in memory and return its bytes."""
+    buffer = BytesIO()
+    try:
+        if exif_bytes:
+            img.save(buffer, format='JPEG', optimize=True, quality=jpeg_quality, exif=exif_bytes)
+        else:
+            img.save(buffer, format='JPEG', optimize=True, quality=jpeg_quality)
+    except Exception:
+        # Fallback without exif parameter if Pillow version doesn't support it
+        buffer = BytesIO()
+        img.save(buffer, format='JPEG', optimize=True, quality=jpeg_quality)
+    return buffer.getvalue()
+
+
+def ssim_boxes(size):
+    """Return the boxes of an image SSIM is computed on: the whole image if it's small enough, otherwise
+    a grid of SSIM_TILE tiles spread evenly over it, SSIM_MAX_PIXELS in total, aligned to JPEG's 8x8 blocks.
+    """
+    width, height = size
+    if width * height <= SSIM_MAX_PIXELS:
+        return [(0, 0, width, height)]
+    tile_width, tile_height = min(SSIM_TILE, width), min(SSIM_TILE, height)
+    count = SSIM_MAX_PIXELS // (tile_width * tile_height)
+    columns = min(width // tile_width, max(1, round(math.sqrt(count * width / height))))
+    rows = min(height // tile_height, max(1, count // columns))
+
+    def offsets(length, tile, n):
+        if n == 1:
+            return [(length - tile) // 2 // 8 * 8]
+        return [(length - tile) * i // (n - 1) // 8 * 8 for i in range(n)]
+
+    return [(x, y, x + tile_width, y + tile_height)
+            for y in offsets(height, tile_height, rows) for x in offsets(width, tile_width, columns)]
+
+
+def luma_planes(img, boxes):
+    """Return the luma (L) plane of each box of an image, at full resolution, as float arrays."""
+    luma = img.convert('L')
+    return [np.asarray(luma.crop(box), dtype=np.float64) for box in boxes]
+
+
+def compute_ssim(a, b):
+    """Mean SSIM of two equally sized luma planes, using a uniform square window."""
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    window = max(1, min(SSIM_WINDOW, *a.shape))
+
+    def window_mean(x):
+        # Sliding window mean through an integral image
+        c = np.pad(x, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+        return (c[window:, window:] - c[:-window, window:] - c[window:, :-window] + c[:-window, :-window]) / (window * window)
+
+    mu_a = window_mean(a)
+    mu_b = window_mean(b)
+    var_a = window_mean(a * a) - mu_a ** 2
+    var_b = window_mean(b * b) - mu_b ** 2
+    covariance = window_mean(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * covariance + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+
+def search_quality(img, exif_bytes=None):
+    """Binary-search the JPEG quality for an image, encoding candidates in memory only.
+
+    In "bytes" mode the highest quality that fits target_bytes is picked, in "ssim" mode the
+    lowest quality whose SSIM (on the full resolution luma, see ssim_boxes) reaches target_ssim.
+    At most max_trials candidates are encoded, counting the one at the fixed quality (encoded to
+    compare sizes); if none qualifies, the closest one is used.
+    Returns (encoded bytes, chosen quality, size at the fixed quality for comparison).
+    """
+    trials = {}
+    by_bytes = quality_search_mode == "bytes"
+    reference = None
+    if not by_bytes:
+        boxes = ssim_boxes(img.size)
+        reference = luma_planes(img, boxes)
+
+    def acceptable(q):
+        data = trials[q] = encode_jpeg(img, q, exif_bytes)
+        if by_bytes:
+            return len(data) <= quality_search_target_bytes
+        with Image.open(BytesIO(data)) as candidate:
+            scores = [compute_ssim(a, b) for a, b in zip(reference, luma_planes(candidate, boxes))]
+        return sum(scores) / len(scores) >= quality_search_target_ssim
+
+    # Size is monotone in quality: bytes mode wants the highest passing quality, ssim mode the lowest.
+    # A trial is kept for the fixed quality, unless the search happens to encode it
+    low, high = quality_search_min_quality, quality_search_max_quality
+    best = None
+    while low <= high and len(trials) + (quality not in trials) < quality_search_max_trials:
+        mid = (low + high) // 2
+        passed = acceptable(mid)
+        if passed:
+            best = mid
+        if passed == by_bytes:
+            low = mid + 1
+        else:
+            high = mid - 1
+    if best is None and trials:
+        # Nothing qualified: smallest candidate for a byte budget, highest quality for a similarity target
+        best = min(trials, key=lambda q: len(trials[q])) if by_bytes else max(trials)
+
+    if quality not in trials:
+        trials[quality] = encode_jpeg(img, quality, exif_bytes)
+    if best is None:
+        # max_trials left no room to search
+        best = quality
+    return trials[best], best, len(trials[quality])
+
+
+# Lazily created thread pool for PNG trials (zlib releases the GIL while compressing)
+_PNG_TRIAL_POOL = None
+_PNG_TRIAL_POOL_LOCK = threading.Lock()
+
+
+def get_png_trial_pool():
+    """Return this process's thread pool for running PNG trials in parallel."""
+    global _PNG_TRIAL_POOL
+    # locked so workers of the thread backend don't each create (and leak) a pool
+    with _PNG_TRIAL_POOL_LOCK:
+        if _PNG_TRIAL_POOL is None:
+            _PNG_TRIAL_POOL = ThreadPoolExecutor(max_workers=max(1, len(png_strategies)))
+    return _PNG_TRIAL_POOL
+
+
+def psnr(a, b):
+    """Peak signal-to-noise ratio (dB) between two images of the same size and mode."""
+    mse = sum(rms ** 2 for rms in ImageStat.Stat(ImageChops.difference(a, b)).rms) / len(a.getbands())
+    return float('inf') if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def png_candidates(img):
+    """Return (label, image, extra save options) variants of an image to try encoding as PNG.
+
+    Lossless reductions (dropping an opaque alpha channel, grayscale, an exact palette with the
+    smallest bit depth) are always tried, a lossy palette only if its PSNR is above the threshold.
+    """
+    if img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+        return [('original', img, {})]
+    work = img.convert('RGBA') if img.mode == 'P' else img
+    candidates = [('original', img, {})]
+
+    # Opaque alpha channel -> drop it
+    if work.mode in ('RGBA', 'LA') and work.getextrema()[-1] == (255, 255):
+        work = work.convert('RGB' if work.mode == 'RGBA' else 'L')
+        candidates.append((f'{work.mode}', work, {}))
+
+    # Gray RGB(A) -> L(A)
+    if work.mode in ('RGB', 'RGBA'):
+        r, g, b = work.split()[:3]
+        if ImageChops.difference(r, g).getbbox() is None and ImageChops.difference(r, b).getbbox() is None:
+            work = work.convert('LA' if work.mode == 'RGBA' else 'L')
+            candidates.append((f'{work.mode}', work, {}))
+
+    if not png_palette or work.mode == '1':
+        return candidates
+
+    # Exact palette when there are few enough colors, stored with the smallest bit depth
+    colors = work.getcolors(256)
+    method = Image.Quantize.FASTOCTREE if work.mode in ('RGBA', 'LA') else Image.Quantize.MEDIANCUT
+    if colors is not None:
+        source = work.convert('RGBA') if work.mode == 'LA' else work
+        paletted = source.quantize(colors=len(colors), method=method, dither=Image.Dither.NONE)
+        if paletted.convert(source.mode).tobytes() == source.tobytes():
+            bits = next(b for b in (1, 2, 4, 8) if len(colors) <= 1 << b)
+            candidates.append((f'palette {bits}-bit', paletted, {'bits': bits}))
+            return candidates
+
+    # Lossy palette, only kept if it stays close enough to the original
+    if png_lossy:
+        source = work.convert('RGBA') if work.mode == 'LA' else work
+        paletted = source.quantize(colors=png_lossy_colors, method=method)
+        if psnr(paletted.convert(source.mode), source) >= png_lossy_min_psnr:
+            candidates.append((f'lossy palette {png_lossy_colors} colors', paletted, {}))
+    return candidates
+
+
+def encode_png_trial(img, options):
+    """Encode one PNG trial in memory and return its bytes."""
+    buffer = BytesIO()
+    img.save(buffer, format='PNG', **options)
+    return buffer.getvalue()
+
+
+def encode_png(img):
+    """Encode a PNG as small as possible: every candidate variant with every zlib strategy, smallest wins.
+
+    Returns (encoded bytes, label of the winning trial).
+    """
+    trials = []
+    for label, candidate, options in png_candidates(img):
+        for strategy in png_strategies:
+            trial_options = dict(options, compress_level=9, compress_type=PNG_STRATEGIES.get(strategy, 0))
+            trials.append((f'{label}, {strategy}', candidate, trial_options))
+    if png_parallel_trials and len(trials) > 1:
+        # Pillow keeps the save options on the image being saved, so each thread saves its own copy
+        results = list(get_png_trial_pool().map(lambda trial: encode_png_trial(trial[1].copy(), trial[2]), trials))
+    else:
+        results = [encode_png_trial(candidate, options) for _, candidate, options in trials]
+    best = min(range(len(trials)), key=lambda i: len(results[i]))
+    return results[best], trials[best][0]
+
+
+def flatten_for_jpeg(img):
+    """Return an RGB version of an image, pasting transparent images onto a white background."""
+    if img.mode in ('RGBA', 'LA'):
+        # Paste onto white background to remove alpha
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        alpha = img.split()[-1]
+        background.paste(img, mask=alpha)
+        return background
+    return img.convert('RGB') if img.mode != 'RGB' else img
+
+
+def encode_original_format(img, ext, exif_bytes=None):
+    """Encode an image in memory in its original format.
+
+    Returns (encoded bytes, searched JPEG quality or None, size at the fixed quality or 0, PNG trial label or None).
+    """
+    # Handle saving differences for JPEG (no alpha channel)
+    if ext in ('.jpg', '.jpeg'):
+        img_to_save = flatten_for_jpeg(img)
+        # Save JPEG with sanitized EXIF if available to avoid keeping orientation tag
+        if quality_search_enabled:
+            return search_quality(img_to_save, exif_bytes) + (None,)
+        return encode_jpeg(img_to_save, quality, exif_bytes), None, 0, None
+    if ext == '.png' and png_enabled:
+        data, png_trial = encode_png(img)
+        return data, None, 0, png_trial
+    buffer = BytesIO()
+    if ext == '.png':
+        # PNG: optimize; quality parameter is not used for PNG by Pillow
+        img.save(buffer, format='PNG', optimize=True)
+    else:
+        # Fallback: let Pillow decide format from extension
+        img.save(buffer, format=Image.registered_extensions()[ext])
+    return buffer.getvalue(), None, 0, None
+
+
+def encode_converted_format(img, ext, exif_bytes=None):
+    """Encode an image in memory in the configured output format (WebP/AVIF), keeping transparency."""
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    kwargs = {}
+    if exif_bytes:
+        kwargs['exif'] = exif_bytes
+    if output_format_target == "webp":
+        # PNGs are usually graphics/screenshots, which compress far better losslessly
+        lossless = output_webp.get("lossless", False) or (ext == '.png' and output_webp.get("lossless_png", True))
+        kwargs['lossless'] = lossless
+        kwargs['quality'] = output_webp.get("quality", 80)
+        kwargs['method'] = output_webp.get("method", 4)
+        if has_alpha and not lossless:
+            # Keep the color of fully transparent pixels out of the encode (smaller, alpha is intact)
+            kwargs['exact'] = False
+    else:
+        kwargs['quality'] = output_avif.get("quality", 60)
+        kwargs['speed'] = output_avif.get("speed", 6)
+    buffer = BytesIO()
+    img.save(buffer, format=OUTPUT_FORMATS[output_format_target][0], **kwargs)
+    return buffer.getvalue()
+
+
+def place_original(original_path, output_path):
+    """Put the original file at output_path as cheaply as possible and return how it was done.
+
+    A hardlink (only if configured, since the output then IS the original and editing it in place
+    edits the original), else a reflink (copy-on-write clone), else an in-kernel copy_file_range,
+    else a plain copy.
+    """
+    if keep_original_method == "hardlink":
+        try:
+            os.link(original_path, output_path)
+            return "hardlink"
+        except OSError:
+            pass
+    with open(original_path, 'rb') as src, open(output_path, 'wb') as dst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except OSError:
+                pass
+        if hasattr(os, 'copy_file_range'):
+            try:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return "copy_file_range"
+            except OSError:
+                pass
+            # Start over with a plain copy
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+        shutil.copyfileobj(src, dst)
+        return "copy"
+
+
+def get_orientation(img):
+    """Return the EXIF orientation (1-8) of an opened image without decoding its pixels."""
+    try:
+        return img.getexif().get(274, 1)
+    except Exception:
+        return 1
+
+
+def orient_stage(img, job):
+    """Apply the EXIF orientation so portrait images aren't rotated."""
+    return ImageOps.exif_transpose(img)
+
+
+def strip_metadata_stage(img, job):
+    """Drop the image's metadata (with Remove EXIF Data's stage) so none of it is written to the output."""
+    job['keep_metadata'] = False
+    return remove_exif_data.strip_metadata(img)
+
+
+def resize_stage(img, job):
+    """Resize to the target size computed from the header (see process_image)."""
+    if not job['should_resize']:
+        return img
+    if resizing_fast_decode:
+        # Two-stage resize: cheap integer reduce() first, then LANCZOS for the last step
+        final_size = thumbnail_size(job['width'], job['height'], job['new_size'])
+        if final_size != img.size:
+            img = img.resize(final_size, RESAMPLE, reducing_gap=resizing_reducing_gap or None)
+        return img
+    # Use high-quality resampling
+    try:
+        img = img.copy()
+        img.thumbnail(job['new_size'], RESAMPLE)
+    except Exception:
+        img = img.resize(job['new_size'], RESAMPLE)
+    return img
+
+
+def watermark_stage(img, job):
+    """Watermark the image with Watermark Photos' stage (configured by its "watermark" section)."""
+    return watermark_photos.watermark_image(img)
+
+
+STAGE_FUNCTIONS = {
+    "orient": orient_stage,
+    "strip_metadata": strip_metadata_stage,
+    "resize": resize_stage,
+    "watermark": watermark_stage,
+}
+
+
+def process_image(original_path, optimized_path, entry=None):
+    """Process a single image: decode it once, run the pipeline stages, encode it once and return
+    (success, log message, manifest entry, stats delta, timing report).
+
+    In incremental mode, entry is the previous manifest entry for this file (if any). When the
+    file's stat changed but its content hash didn't, the encode is skipped. The timing report is
+    None unless instrumentation is enabled.
+    """
+    timer = watermark_photos.StageTimer(original_path) if instrumentation_enabled else watermark_photos.NULL_TIMER
     try:
         # Ensure output dir exists
         os.makedirs(os.path.dirname(optimized_path), exist_ok=True)
 
-        original_size = os.path.getsize(original_path)
+        file_stat = os.stat(original_path)
+        original_size = file_stat.st_size
+        ext = os.path.splitext(optimized_path)[1].lower()
 
+        content_hash = None
+        if incremental_enabled:
+            with timer.stage('hash'):
+                content_hash = hash_file(original_path)
+            if (entry and entry.get('hash') == content_hash and os.path.exists(entry_output(entry, optimized_path))
+                    and entry.get('fingerprint') == config_fingerprint(ext, entry.get('width', 0), entry.get('height', 0))):
+                # Only the stat changed (touched/copied), the output is still valid
+                new_entry = dict(entry, size=original_size, mtime_ns=file_stat.st_mtime_ns)
+                rel_original = os.path.relpath(original_path, original_folder)
+                return True, f"{green}{rel_original} - unchanged, skipped{reset}", new_entry, {'skipped': 1}, timer.report()
+
+        chosen_quality = None
+        fixed_size = 0
+        png_trial = None
         with Image.open(original_path) as img:
-            # Ensure EXIF orientation is applied so portrait images aren't rotated
-            img = ImageOps.exif_transpose(img)
+            with timer.stage('decode'):
+                # Size after applying the EXIF orientation, known from the header before decoding
+                width, height = img.size
+                orientation = get_orientation(img) if orient_before_resize else 1
+                if orientation in (5, 6, 7, 8):
+                    width, height = height, width
+                new_size = compute_target_size(width, height) if "resize" in pipeline_stages else None
+                should_resize = new_size is not None
 
-            # Try to get EXIF and remove orientation tag so saved file won't contain a leftover tag
-            exif = None
-            try:
-                if hasattr(img, 'getexif'):
-                    exif = img.getexif()
-                    # Remove orientation tag (274) if present
-                    if exif is not None and 274 in exif:
-                        try:
+                # Fast decode: let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding (DCT scaling),
+                # keeping at least reducing_gap times the target size for the final resample
+                if should_resize and resizing_fast_decode and img.format == 'JPEG':
+                    gap = max(1.0, resizing_reducing_gap or 1.0)
+                    draft_size = (int(new_size[0] * gap), int(new_size[1] * gap))
+                    if orientation in (5, 6, 7, 8):
+                        draft_size = draft_size[::-1]
+                    img.draft(img.mode, draft_size)
+                img.load()
+
+            # Single pass: every configured stage works on the one decoded image
+            job = {'width': width, 'height': height, 'new_size': new_size, 'should_resize': should_resize,
+                   'keep_metadata': True}
+            for stage in pipeline_stages:
+                with timer.stage(stage):
+                    img = STAGE_FUNCTIONS[stage](img, job)
+
+            with timer.stage('encode'):
+                # Keep the EXIF data, without the orientation tag once the image has been oriented
+                exif_bytes = None
+                if job['keep_metadata']:
+                    try:
+                        exif = img.getexif()
+                        if "orient" in pipeline_stages and 274 in exif:
                             del exif[274]
-                        except Exception:
-                            # ignore if deletion fails
-                            pass
-            except Exception:
-                exif = None
-
-            width, height = img.size
-            should_resize = False
-            if resizing_enabled:
-                if not resizing_upscale and width <= resizing_max_width and height <= resizing_max_height:
-                    should_resize = False
-                else:
-                    if width > resizing_max_width or height > resizing_max_height or resizing_upscale:
-                        should_resize = True
-
-            if should_resize:
-                ratio = min(resizing_max_width / width, resizing_max_height / height)
-                new_size = (max(1, int(width * ratio)), max(1, int(height * ratio)))
-                # Use high-quality resampling
-                try:
-                    img = img.copy()
-                    img.thumbnail(new_size, RESAMPLE)
-                except Exception:
-                    img = img.resize(new_size, RESAMPLE)
-
-            # Handle saving differences for JPEG (no alpha channel)
-            ext = os.path.splitext(optimized_path)[1].lower()
-            if ext in ('.jpg', '.jpeg'):
-                if img.mode in ('RGBA', 'LA'):
-                    # Paste onto white background to remove alpha
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    alpha = img.split()[-1]
-                    background.paste(img, mask=alpha)
-                    img_to_save = background
-                else:
-                    img_to_save = img.convert('RGB') if img.mode != 'RGB' else img
-                # Save JPEG with sanitized EXIF if available to avoid keeping orientation tag
-                try:
-                    if exif is not None:
-                        try:
-                            exif_bytes = exif.tobytes()
-                        except Exception:
-                            exif_bytes = None
-                        if exif_bytes:
-                            img_to_save.save(optimized_path, optimize=True, quality=quality, exif=exif_bytes)
-                        else:
-                            img_to_save.save(optimized_path, optimize=True, quality=quality)
+                        exif_bytes = exif.tobytes()
+                    except Exception:
+                        exif_bytes = None
+
+                # Encode in memory: converted format and/or original format, keeping the smaller one
+                data = None
+                output_path = optimized_path
+                if output_format_supported:
+                    data = encode_converted_format(img, ext, exif_bytes)
+                    output_path = converted_path(optimized_path)
+                if data is None or output_format_keep_smaller:
+                    original_data, chosen_quality, fixed_size, png_trial = encode_original_format(img, ext, exif_bytes)
+                    if data is None or len(original_data) <= len(data):
+                        data = original_data
+                        output_path = optimized_path
                     else:
-                        img_to_save.save(optimized_path, optimize=True, quality=quality)
-                except Exception:
-                    # Fallback without exif parameter if Pillow version doesn't support it
-                    img_to_save.save(optimized_path, optimize=True, quality=quality)
-            elif ext == '.png':
-                # PNG: optimize; quality parameter is not used for PNG by Pillow
-                img.save(optimized_path, optimize=True)
-            else:
-                # Fallback: let Pillow decide format from extension
-                img.save(optimized_path)
+                        # Converted output won, the quality search/PNG trial result wasn't used
+                        chosen_quality = None
+                        png_trial = None
+
+        # Keep the original when re-encoding doesn't make it meaningfully smaller (resized images are always re-encoded)
+        kept_original = None
+        keep = (keep_original_enabled and not should_resize and not pipeline_modifies
+                and len(data) > original_size * (1 - keep_original_min_saving_percent / 100.0))
+        if keep:
+            output_path = optimized_path
+            chosen_quality = None
+            png_trial = None
 
-        optimized_size = os.path.getsize(optimized_path) if os.path.exists(optimized_path) else 0
+        with timer.stage('write'):
+            # Never write through an existing output, it may be a hardlink to an original
+            if os.path.lexists(output_path):
+                os.remove(output_path)
+            if keep:
+                kept_original = place_original(original_path, output_path)
+                optimized_size = original_size
+            else:
+                with open(output_path, 'wb') as out:
+                    out.write(data)
+                optimized_size = len(data)
+            # Remove an output left in the other format by a previous run
+            for candidate in output_candidates(optimized_path):
+                if candidate != output_path and os.path.exists(candidate):
+                    os.remove(candidate)
 
         # Compute reduction
         saved_bytes = max(0, original_size - optimized_size)
@@ -200,70 +913,169 @@ def process_image(original_path, optimized_path):
 
         msg = (f"{green}{rel_original}"
                f"{(' (resized)' if should_resize else '')}"
+               f"{(f' (quality {chosen_quality})' if chosen_quality is not None else '')}"
+               f"{(f' (as {output_format_target.upper()})' if output_path != optimized_path else '')}"
+               f"{(f' ({png_trial})' if png_trial else '')}"
+               f"{(f' (kept original, {kept_original})' if kept_original else '')}"
                f" - {human_readable_bytes(original_size)} -> {human_readable_bytes(optimized_size)} ({percent:.1f}% reduction){reset}")
 
-        # Update stats
-        with stats_lock:
-            stats['success'] += 1
-            if should_resize:
-                stats['resized'] += 1
-            stats['processed'] += 1
-            stats['total_original_bytes'] += original_size
-            stats['total_optimized_bytes'] += optimized_size
+        # Stats for the main process to add up
+        delta = {
+            'success': 1,
+            'resized': 1 if should_resize else 0,
+            'total_original_bytes': original_size,
+            'total_optimized_bytes': optimized_size,
+            'total_pixels': width * height,
+        }
+        if kept_original:
+            delta['kept_original'] = 1
+            delta['kept_original_encoded_bytes'] = len(data)
+        if chosen_quality is not None:
+            delta['searched'] = 1
+            delta['searched_bytes'] = optimized_size
+            delta['fixed_quality_bytes'] = fixed_size
+
+        new_entry = None
+        if incremental_enabled:
+            new_entry = {
+                'size': original_size,
+                'mtime_ns': file_stat.st_mtime_ns,
+                'hash': content_hash,
+                'width': width,
+                'height': height,
+                'fingerprint': config_fingerprint(ext, width, height),
+                'optimized_size': optimized_size,
+                'output': os.path.relpath(output_path, optimized_folder),
+            }
 
-        return True, msg
+        return True, msg, new_entry, delta, timer.report(pixels=width * height, output_bytes=optimized_size)
 
     except Exception as e:
-        with stats_lock:
-            stats['fail'] += 1
-            stats['processed'] += 1
         msg = f"{red}Error optimizing {original_path}: {e}{reset}"
-        return False, msg
-
-
-# Collect files to process
-files_to_process = []
-for root, dirs, files in os.walk(original_folder):
-    for file in files:
-        if file.lower().endswith(VALID_EXTS):
-            original_path = os.path.join(root, file)
-            relative_path = os.path.relpath(original_path, original_folder)
-            optimized_path = os.path.join(optimized_folder, relative_path)
-            files_to_process.append((original_path, optimized_path))
-
-total_files = len(files_to_process)
-# Compute a tight progress column width based on BAR_LENGTH and total_files so the
-# progress area is no wider than necessary and the file message begins one space later.
-PROGRESS_COL_WIDTH = len(f"[{'#'*BAR_LENGTH}] {total_files}/{total_files} (100%)")
-
-print(f"{blue}Starting image optimization process on {total_files} files with {max_workers} workers...{reset}")
-
-# Run in parallel
-with ThreadPoolExecutor(max_workers=max_workers) as ex:
-    future_to_file = {ex.submit(process_image, o, p): (o, p) for o, p in files_to_process}
-    for future in as_completed(future_to_file):
-        success_flag, message = future.result()
-        # Update progress bar (read thread-safe processed count)
-        with stats_lock:
-            current = stats['processed']
-        # Write progress and message together so message always starts in the same column
-        progress_str = print_progress_bar(current, total_files)
-        # Use carriage return to overwrite line and then write progress + a single space + message + newline
-        sys.stdout.write('\r' + progress_str + ' ' + message + '\n')
-        sys.stdout.flush()
-
-# Move to next line after progress bar
-sys.stdout.write("\n")
-
-# Final summary
-success = stats['success']
-fail = stats['fail']
-resized = stats['resized']
-orig_bytes = stats['total_original_bytes']
-opt_bytes = stats['total_optimized_bytes']
-bytes_saved = max(0, orig_bytes - opt_bytes)
-percent_saved = (bytes_saved / orig_bytes * 100.0) if orig_bytes > 0 else 0.0
-
-print(f"{blue}Successfully optimized {success} files with {fail} failures ({resized} images resized){reset}")
-print(f"{blue}Total size: {human_readable_bytes(orig_bytes)} -> {human_readable_bytes(opt_bytes)}, "
-      f"saved {human_readable_bytes(bytes_saved)} ({percent_saved:.1f}% total reduction){reset}")
+        return False, msg, None, {'fail': 1}, timer.report(error=str(e))
+
+
+# --- Main entry: gather images and run in parallel (guarded so process workers can import this file) ---
+if __name__ == "__main__":
+    # Delete existing optimized_folder (incremental mode keeps it and only updates what changed)
+    if not incremental_enabled and os.path.exists(optimized_folder):
+        try:
+            shutil.rmtree(optimized_folder)
+        except Exception as e:
+            print(f"{red}Failed to remove optimized folder {optimized_folder}: {e}{reset}")
+
+    # Load the previous run's manifest (incremental mode only)
+    manifest = load_manifest(incremental_manifest) if incremental_enabled else {}
+    new_manifest = {}
+    expected_outputs = set()
+
+    # Collect files to process (streaming mode processes them while the folder is still being walked)
+    if parallel_streaming:
+        original_paths = watermark_photos.StreamingScanner(original_folder, VALID_EXTS, exclude=())
+    else:
+        original_paths = sorted(watermark_photos.scan_images(original_folder, VALID_EXTS, exclude=()))
+    tasks = (task for task in (build_task(o, manifest, new_manifest, expected_outputs) for o in original_paths) if task)
+    discovery = {'found': 0, 'done': False}
+    if parallel_streaming:
+        tasks = watermark_photos.track_discovery(tasks, discovery)
+        # Totals aren't known up front, leave room for up to 7 digit counts
+        PROGRESS_COL_WIDTH = len(f"[{'#'*BAR_LENGTH}] 9999999/9999999+ (100%)")
+        total_label = "streamed"
+    else:
+        tasks = list(tasks)
+        discovery = {'found': len(tasks), 'done': True}
+        # Compute a tight progress column width based on BAR_LENGTH and total_files so the
+        # progress area is no wider than necessary and the file message begins one space later.
+        PROGRESS_COL_WIDTH = len(f"[{'#'*BAR_LENGTH}] {len(tasks)}/{len(tasks)} (100%)")
+        total_label = str(len(tasks))
+
+    if output_format_target and not output_format_supported:
+        print(f"{red}Output format {output_format_target} isn't supported by this Pillow build, keeping the original formats{reset}")
+
+    max_workers = pick_worker_count(parallel_backend)
+    print(f"{blue}Starting image optimization process on {total_label} files with {max_workers} {parallel_backend} workers...{reset}")
+
+    # Per-file timing reports (JSONL, one line per file as it completes) and their aggregate (JSON)
+    reports = []
+    report_lines = open(os.path.splitext(instrumentation_report)[0] + ".jsonl", 'w') if instrumentation_enabled else None
+
+    # Run in parallel
+    start_time = time.perf_counter()
+    try:
+        if parallel_backend == "process":
+            # Chunks amortize the pickling/IPC round trip per task
+            chunks = chunked(tasks, parallel_chunk_size)
+            executor = ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker)
+        else:
+            chunks = chunked(tasks, 1)
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        with executor as ex:
+            completed = watermark_photos.run_with_memory_budget(
+                ex, process_chunk, chunks,
+                cost_fn=lambda chunk: sum(estimate_decoded_bytes(o) for o, _, _ in chunk),
+                budget=watermark_photos.get_memory_budget(parallel_memory_budget_mb),
+                max_in_flight=max_workers * 2,
+            )
+            for chunk, results in completed:
+                for (original_path, _, _), (success_flag, message, new_entry, delta, report) in zip(chunk, results):
+                    if report is not None:
+                        reports.append(report)
+                        report_lines.write(json.dumps(report) + '\n')
+                    if new_entry is not None:
+                        new_manifest[os.path.relpath(original_path, original_folder)] = new_entry
+                    for key, value in delta.items():
+                        stats[key] += value
+                    stats['processed'] += 1
+                    # Write progress and message together so message always starts in the same column
+                    progress_str = print_progress_bar(stats['processed'], discovery['found'], total_known=discovery['done'])
+                    # Use carriage return to overwrite line and then write progress + a single space + message + newline
+                    sys.stdout.write('\r' + progress_str + ' ' + message + '\n')
+                    sys.stdout.flush()
+    finally:
+        # Save even if interrupted so finished files aren't redone next run
+        if incremental_enabled:
+            # Outputs (and manifest entries) whose source was deleted or renamed, only safe once every source was seen
+            if discovery['done']:
+                stats['pruned'] = prune_outputs(manifest, expected_outputs) if os.path.exists(optimized_folder) else 0
+            try:
+                save_manifest(incremental_manifest, new_manifest)
+            except Exception as e:
+                print(f"{red}Failed to save manifest {incremental_manifest}: {e}{reset}")
+
+    elapsed = time.perf_counter() - start_time
+    if report_lines is not None:
+        report_lines.close()
+        watermark_photos.write_run_report(instrumentation_report, reports, elapsed)
+
+    # Move to next line after progress bar
+    sys.stdout.write("\n")
+
+    # Final summary
+    success = stats['success']
+    fail = stats['fail']
+    resized = stats['resized']
+    orig_bytes = stats['total_original_bytes']
+    opt_bytes = stats['total_optimized_bytes']
+    bytes_saved = max(0, orig_bytes - opt_bytes)
+    percent_saved = (bytes_saved / orig_bytes * 100.0) if orig_bytes > 0 else 0.0
+
+    print(f"{blue}Successfully optimized {success} files with {fail} failures ({resized} images resized){reset}")
+    if incremental_enabled:
+        unchanged = len(new_manifest) - stats['success']
+        print(f"{blue}Incremental mode: {unchanged} unchanged files skipped, {stats['pruned']} stale outputs pruned{reset}")
+    if stats['searched']:
+        search_saved = stats['fixed_quality_bytes'] - stats['searched_bytes']
+        search_percent = (search_saved / stats['fixed_quality_bytes'] * 100.0) if stats['fixed_quality_bytes'] > 0 else 0.0
+        print(f"{blue}Quality search ({quality_search_mode}) on {stats['searched']} JPEGs: "
+              f"{human_readable_bytes(stats['searched_bytes'])} vs {human_readable_bytes(stats['fixed_quality_bytes'])} at fixed quality {quality} "
+              f"({'saved' if search_saved >= 0 else 'spent'} {human_readable_bytes(abs(search_saved))}, {abs(search_percent):.1f}%){reset}")
+    if stats['kept_original']:
+        print(f"{blue}Kept {stats['kept_original']} originals whose re-encode wasn't at least {keep_original_min_saving_percent}% smaller "
+              f"(re-encoding them would have written {human_readable_bytes(stats['kept_original_encoded_bytes'])}){reset}")
+    print(f"{blue}Total size: {human_readable_bytes(orig_bytes)} -> {human_readable_bytes(opt_bytes)}, "
+          f"saved {human_readable_bytes(bytes_saved)} ({percent_saved:.1f}% total reduction){reset}")
+    if elapsed > 0:
+        print(f"{blue}Throughput: {stats['processed'] / elapsed:.2f} images/s, {stats['total_pixels'] / elapsed / 1e6:.1f} MP/s "
+              f"({elapsed:.1f}s, {parallel_backend} backend){reset}")
+    if instrumentation_enabled:
+        print(f"{blue}Timing report written to {instrumentation_report}{reset}")
@@ -1,4 +1,8 @@
 import os
+import json
+import struct
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from PIL import Image
 
 # Colors
@@ -7,25 +11,265 @@ green = "\033[32m"
 blue = "\033[34m"
 reset = "\033[0m"
 
+# Load config (optional, everything has a default)
+config = {}
+if os.path.exists("config.json"):
+    with open("config.json", 'r') as f:
+        config = json.load(f).get("exif_removal", {})
+folder = config.get("folder", ".")
+lossless = config.get("lossless", True)
+remove_xmp = config.get("xmp", False)
+remove_iptc = config.get("iptc", False)
+exclude = set(config.get("exclude", [".git"]))
+dry_run = config.get("dry_run", False)
+workers = config.get("workers", "auto")
+if not isinstance(workers, int) or workers < 1:
+    # reading headers is mostly waiting on the disk, so use more threads than cores
+    workers = min(32, (os.cpu_count() or 1) * 4)
 
-# Remove EXIF data from images in current directory and subdirectories
-print(f"{blue}Starting EXIF data removal process...")
-success = 0
-fail = 0
-for root, dirs, files in os.walk("."):
-    for file in files:
-        if file.lower().endswith((".jpg", ".jpeg", ".tiff", ".png")):
-            file_path = os.path.join(root, file)
+IMAGE_EXTS = (".jpg", ".jpeg", ".tiff", ".png")
+
+# JPEG markers: start of image, APP1 (EXIF, XMP), APP13 (IPTC), start of scan, end of image
+JPEG_SOI = b'\xff\xd8'
+JPEG_APP1 = 0xE1
+JPEG_APP13 = 0xED
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+# Identifiers at the start of APPn segments
+EXIF_ID = b'Exif\x00\x00'
+XMP_IDS = (b'http://ns.adobe.com/xap/1.0/\x00', b'http://ns.adobe.com/xmp/extension/\x00')
+IPTC_ID = b'Photoshop 3.0\x00'
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_TEXT_CHUNKS = (b'tEXt', b'zTXt', b'iTXt')
+# Keywords of PNG text chunks holding XMP or IPTC (the other text chunks are always removed)
+PNG_XMP_KEYWORD = b'XML:com.adobe.xmp'
+PNG_IPTC_KEYWORDS = (b'Raw profile type iptc', b'Raw profile type 8bim')
+# TIFF tags holding camera/EXIF data that re-saving removes: description, make, model, software,
+# date, artist, copyright and the pointers to the EXIF and GPS data
+TIFF_EXIF_TAGS = (270, 271, 272, 305, 306, 315, 33432, 34665, 34853)
+
+
+# Import one of the other scripts (next to this one) as a module, to use its code
+def load_sibling_script(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", name, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(name.lower().replace(' ', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Folders are walked with Watermark Photos' StreamingScanner
+watermark_photos = load_sibling_script("Watermark Photos")
+
+
+# Yield (offset, length) of the metadata segments of a JPEG, reading only segment headers.
+# Stops at the start of the compressed image data, metadata can't come after it
+def jpeg_metadata_segments(f):
+    if f.read(2) != JPEG_SOI:
+        raise ValueError("not a JPEG")
+    while True:
+        offset = f.tell()
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("corrupt JPEG")
+        code = marker[1]
+        # fill bytes before a marker
+        while code == 0xFF:
+            code = f.read(1)[0]
+        if code in (JPEG_SOS, JPEG_EOI):
+            return
+        # markers without a length (TEM, RSTn)
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        start = f.tell()
+        length = struct.unpack(">H", f.read(2))[0]
+        if length < 2:
+            raise ValueError("corrupt JPEG")
+        header = f.read(min(length - 2, 35))
+        end = start + length
+        f.seek(end)
+        if code == JPEG_APP1 and (header.startswith(EXIF_ID) or (remove_xmp and header.startswith(XMP_IDS))):
+            yield offset, end - offset
+        elif code == JPEG_APP13 and remove_iptc and header.startswith(IPTC_ID):
+            yield offset, end - offset
+
+
+# Yield (offset, length) of the metadata chunks of a PNG (eXIf and text chunks), reading only chunk headers
+def png_metadata_chunks(f):
+    if f.read(8) != PNG_SIGNATURE:
+        raise ValueError("not a PNG")
+    while True:
+        offset = f.tell()
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError("truncated PNG")
+        length, kind = struct.unpack(">I4s", header)
+        if kind == b'IEND':
+            return
+        if kind in PNG_TEXT_CHUNKS:
+            keyword = f.read(min(length, 80)).split(b'\x00', 1)[0]
+            if keyword == PNG_XMP_KEYWORD:
+                removed = remove_xmp
+            elif keyword in PNG_IPTC_KEYWORDS:
+                removed = remove_iptc
+            else:
+                removed = True
+        else:
+            removed = kind == b'eXIf'
+        # skip the chunk data and CRC
+        f.seek(offset + 12 + length)
+        if removed:
+            yield offset, 12 + length
+
+
+# Return (offset, length) of every metadata segment/chunk of a JPEG or PNG, reading headers only
+def find_metadata(file_path):
+    with open(file_path, 'rb') as f:
+        if file_path.lower().endswith(".png"):
+            return list(png_metadata_chunks(f))
+        return list(jpeg_metadata_segments(f))
+
+
+# Copy length bytes (or everything left when length is None) from one file to another, in 1 MB pieces
+def copy_bytes(src, dst, length=None):
+    while length is None or length > 0:
+        piece = src.read(1024 * 1024 if length is None else min(length, 1024 * 1024))
+        if not piece:
+            return
+        dst.write(piece)
+        if length is not None:
+            length -= len(piece)
+
+
+# Remove the metadata segments/chunks (found by find_metadata) of a JPEG or PNG by rewriting its
+# container: every other byte (including the compressed image data) is copied as-is, so the pixels
+# are untouched and nothing is decoded. Returns the number of bytes removed
+def strip_container(file_path, segments):
+    tmp_path = file_path + ".tmp"
+    try:
+        with open(file_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            position = 0
+            for offset, length in segments:
+                copy_bytes(src, dst, offset - position)
+                src.seek(offset + length)
+                position = offset + length
+            copy_bytes(src, dst)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        # don't leave a partial copy next to the image
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return sum(length for _, length in segments)
+
+
+# Find out whether an image has metadata to remove, from its headers only.
+# Returns (whether it has any, its size in bytes or None if unknown, segments for strip_container
+# or None when the image has to be re-saved with Pillow to remove it)
+def inspect_image(file_path):
+    if lossless and file_path.lower().endswith((".jpg", ".jpeg", ".png")):
+        try:
+            segments = find_metadata(file_path)
+            return bool(segments), sum(length for _, length in segments), segments
+        except (ValueError, IndexError, struct.error):
+            # not a well-formed JPEG/PNG (e.g. wrong extension), let Pillow handle it
+            pass
+    with Image.open(file_path) as img:
+        tags = getattr(img, "tag_v2", {})
+        has_metadata = "exif" in img.info or any(tag in tags for tag in TIFF_EXIF_TAGS)
+    return has_metadata, None, None
+
+
+# Drop the EXIF data of an opened image so saving it won't write it back, and return the image.
+# Also used as the "strip_metadata" stage of Optimize Photos' pipeline
+def strip_metadata(img):
+    img.info.pop("exif", None)
+    return img
+
+
+# Remove EXIF data from one image. JPEGs and PNGs are rewritten losslessly (see strip_container),
+# other images (and all of them when lossless is disabled) are replaced with a re-saved copy.
+# Images without metadata are left alone.
+# Returns the number of bytes removed, or None when the image was re-saved
+def remove_exif(file_path):
+    has_metadata, _, segments = inspect_image(file_path)
+    if not has_metadata:
+        return 0
+    if segments:
+        return strip_container(file_path, segments)
+    tmp_path = file_path + ".tmp"
+    try:
+        with Image.open(file_path) as img:
+            strip_metadata(img).save(tmp_path, format=img.format)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return None
+
+
+# Check (dry run) or remove the metadata of one image. Returns (whether it had metadata, its size in bytes or None if unknown)
+def process_image(file_path):
+    if dry_run:
+        has_metadata, size, _ = inspect_image(file_path)
+        return has_metadata, size
+    removed = remove_exif(file_path)
+    return removed != 0, removed
+
+
+# Submit fn(item) for every item and yield (item, result or exception) as they complete,
+# with at most max_in_flight items submitted at once so a huge folder isn't queued all at once
+def run_bounded(ex, fn, items, max_in_flight):
+    in_flight = {}
+
+    def collect():
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = in_flight.pop(future)
             try:
-                with Image.open(file_path) as img:
-                    tmp_path = file_path + ".tmp"
-                    img.info.pop("exif", None)
-                    img.save(tmp_path, format=img.format)
-                os.replace(tmp_path, file_path)
-                print(f"{green}Removed EXIF data from {file_path}")
-                success += 1
+                yield item, future.result()
             except Exception as e:
-                print(f"{red}Error processing {file_path}: {e}")
+                yield item, e
+
+    for item in items:
+        if len(in_flight) >= max_in_flight:
+            yield from collect()
+        in_flight[ex.submit(fn, item)] = item
+    while in_flight:
+        yield from collect()
+
+
+# Remove EXIF data from images in the folder and its subdirectories
+if __name__ == "__main__":
+    print(f"{blue}Starting EXIF data {'check (dry run)' if dry_run else 'removal process'} with {workers} workers...")
+    success = 0
+    fail = 0
+    clean = 0
+    total_bytes = 0
+    unknown = 0
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for file_path, result in run_bounded(ex, process_image, watermark_photos.StreamingScanner(folder, IMAGE_EXTS, exclude), workers * 4):
+            if isinstance(result, Exception):
+                print(f"{red}Error processing {file_path}: {result}")
                 fail += 1
+                continue
+            has_metadata, size = result
+            success += 1
+            if not has_metadata:
+                clean += 1
+                continue
+            if size is None:
+                unknown += 1
+            else:
+                total_bytes += size
+            size_text = f" ({size} bytes)" if size is not None else ""
+            print(f"{green}{'Would remove' if dry_run else 'Removed'} EXIF data from {file_path}{size_text}")
 
-print(f"{blue}Successfully removed EXIF data from {success} files ({fail} failures){reset}")
+    if dry_run:
+        print(f"{blue}Would remove {total_bytes} bytes of metadata from {success - clean} files "
+              f"({unknown} of them re-saved, size unknown), {clean} files have none ({fail} failures){reset}")
+    else:
+        print(f"{blue}Successfully removed {total_bytes} bytes of EXIF data from {success - clean} files "
+              f"({unknown} of them re-saved, {clean} had none, {fail} failures){reset}")
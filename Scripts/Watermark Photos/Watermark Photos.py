@@ -2,10 +2,25 @@ import os
 import sys
 import json
 import math
+import time
 import hashlib
 import shutil
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from PIL import Image, ImageDraw, ImageFont
+import contextlib
+import mmap
+import struct
+import tempfile
+import zlib
+from io import BytesIO
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+# resource (peak RSS) isn't available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Colors
 red = "\033[31m"
@@ -14,7 +29,12 @@ blue = "\033[34m"
 reset = "\033[0m"
 
 # cap to keep font rasterization reasonable
-MAX_FONT = 2048
+MAX_FONT = 4096
+# Longest side of the rotated watermark as rendered once per run, scaled down to each image's size
+CANONICAL_SIZE = 4096
+# Images bigger than that get it rendered again at twice the size (scaling text up blurs it), up to
+# this size; past it the watermark is scaled up (bigger renders take too much memory per worker)
+MAX_RENDER_SIZE = 8192
 
 # Visual bar length (characters inside the [....])
 BAR_LENGTH = 20
@@ -34,26 +54,45 @@ def hex_to_rgba(hex_color, alpha):
     return r, g, b, a
 
 
-# Load config
-if not os.path.exists("config.json"):
+# Load config (only optional when another script imports this one, e.g. Image Dither for its PNG streaming)
+config = {}
+if os.path.exists("config.json"):
+    with open("config.json", 'r') as f:
+        config = json.load(f).get("watermark", {})
+elif __name__ == "__main__":
     print(f"{red}Config file config.json not found! Please create it with the necessary settings{reset}")
     sys.exit(1)
-with open("config.json", 'r') as f:
-    config = json.load(f).get("watermark", {})
-    folder = config.get("folder")
-    text = config.get("text", "Watermark Text")
-    rotation = config.get("rotation", 45)
-    font = config.get("font", {})
-    font_family = font.get("family", "arial.ttf")
-    opacity = font.get("opacity", 0.5)
-    font_color = hex_to_rgba(font.get("color", "#FFFFFF"), opacity)
-
-# create a simple on-disk cache for watermark layers keyed by settings + image size
-cache_dir = os.path.join(folder, ".watermark_cache")
-try:
-    os.makedirs(cache_dir, exist_ok=True)
-except Exception:
-    cache_dir = None
+folder = config.get("folder")
+text = config.get("text", "Watermark Text")
+rotation = config.get("rotation", 45)
+font = config.get("font", {})
+font_family = font.get("family", "arial.ttf")
+opacity = font.get("opacity", 0.5)
+font_color = hex_to_rgba(font.get("color", "#FFFFFF"), opacity)
+parallel = config.get("parallel", {})
+memory_budget_mb = parallel.get("memory_budget_mb", "auto")
+streaming = parallel.get("streaming", False)
+cache = config.get("cache", {})
+cache_memory_mb = cache.get("memory_mb", 1024)
+tiling = config.get("tiling", {})
+tiling_enabled = tiling.get("enabled", True)
+tiling_min_megapixels = tiling.get("min_megapixels", 100)
+tiling_band_rows = tiling.get("band_rows", 256)
+journal = config.get("journal", {})
+journal_enabled = journal.get("enabled", True)
+journal_file = journal.get("file")
+instrumentation = config.get("instrumentation", {})
+instrumentation_enabled = instrumentation.get("enabled", False)
+instrumentation_report = instrumentation.get("report", "watermark_report.json")
+
+# Journal of watermarked images (one JSON record per line). It's kept next to config.json, one per
+# folder, rather than in the folder, where other tools (e.g. Optimize Photos' pruning) could delete it
+journal_path = None
+if journal_enabled and folder:
+    folder_id = hashlib.sha1(os.path.abspath(folder).encode('utf-8')).hexdigest()[:12]
+    journal_path = journal_file or f".watermark_journal_{folder_id}.jsonl"
+# Where older versions kept the journal, moved to journal_path on the next run
+LEGACY_JOURNAL_PATH = os.path.join(folder, ".watermark_journal.jsonl") if folder else None
 
 # small in-process font cache to avoid repeated expensive truetype loads
 _FONT_CACHE = {}
@@ -62,6 +101,13 @@ _FONT_CACHE = {}
 # Set to a numeric value instead of None if you want a hard limit.
 Image.MAX_IMAGE_PIXELS = None
 
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+# Directories scan_images doesn't go into by default: caches left by older versions
+LEGACY_CACHE_DIRS = ('.watermark_cache',)
+
+# Full-size buffers alive at once per image (decoded image, RGB copy or encoded output)
+DECODE_OVERHEAD = 2
+
 # Determine resampling filter in a backward/forward-compatible way
 RESAMPLE = None
 _resampling_attr = getattr(Image, 'Resampling', None)
@@ -71,66 +117,48 @@ if RESAMPLE is None:
     RESAMPLE = getattr(Image, 'LANCZOS', getattr(Image, 'ANTIALIAS', 1))
 
 
-# --- New helper: simplified and faster watermark creation + cache save/load ---
-def create_watermark_layer(image_size, cache_key_obj):
-    # quick return if nothing to draw
-    if not text:
-        return Image.new("RGBA", image_size, (255, 255, 255, 0))
-
-    cache_path = None
-    if cache_dir:
-        key_bytes = json.dumps(cache_key_obj, sort_keys=True).encode("utf-8")
-        sha = hashlib.sha1(key_bytes).hexdigest()
-        cache_path = os.path.join(cache_dir, f"{sha}.png")
-        if os.path.exists(cache_path):
-            try:
-                cached = Image.open(cache_path).convert("RGBA")
-                if cached.size == image_size:
-                    return cached
-                else:
-                    try:
-                        os.remove(cache_path)
-                    except Exception:
-                        pass
-            except Exception:
-                try:
-                    os.remove(cache_path)
-                except Exception:
-                    pass
-
-    # create transparent watermark layer
-    watermark = Image.new("RGBA", image_size, (255, 255, 255, 0))
-
-    # simple render flow (multi-line centered)
+# Render the watermark text and rotate it, once per render size.
+# Returns the rotated alpha mask of the text and the center of its visible pixels
+def render_watermark(render_size=CANONICAL_SIZE):
     lines = text.splitlines()
     angle = rotation if isinstance(rotation, (int, float)) else -45
 
-    # render at a reasonably large but capped size to avoid extremely slow font rasterization
-    diag = int(math.hypot(image_size[0], image_size[1]))
-    base_font_size = max(64, min(int(diag * 0.5), MAX_FONT))
+    # measure the text at a small size first, then pick the font size that makes the rotated
+    # layer render_size pixels on its longest side (capped to keep font rasterization reasonable)
+    def measure(font_size):
+        try:
+            base_font = _FONT_CACHE.get((font_family, font_size))
+            if base_font is None:
+                base_font = ImageFont.truetype(font_family, font_size)
+                _FONT_CACHE[(font_family, font_size)] = base_font
+        except Exception:
+            print(f"{red}Warning: failed to load font '{font_family}' at size {font_size}, using default font{reset}")
+            base_font = ImageFont.load_default()
 
-    # reuse loaded fonts in this process
-    font_cache_key = (font_family, base_font_size)
-    try:
-        base_font = _FONT_CACHE.get(font_cache_key)
-        if base_font is None:
-            base_font = ImageFont.truetype(font_family, base_font_size)
-            _FONT_CACHE[font_cache_key] = base_font
-    except Exception:
-        print(f"{red}Warning: failed to load font '{font_family}' at size {base_font_size}, using default font{reset}")
-        base_font = ImageFont.load_default()
-
-    temp = Image.new("RGBA", (1, 1), (0, 0, 0, 0))
-    td = ImageDraw.Draw(temp)
-    line_sizes = []
-    for line in lines:
-        if hasattr(td, "textbbox"):
-            l, t, r, b = td.textbbox((0, 0), line, font=base_font)
-            w, h = r - l, b - t
-        else:
-            mask = base_font.getmask(line)
-            w, h = mask.size
-        line_sizes.append((w, h))
+        temp = Image.new("RGBA", (1, 1), (0, 0, 0, 0))
+        td = ImageDraw.Draw(temp)
+        line_sizes = []
+        for line in lines:
+            if hasattr(td, "textbbox"):
+                l, t, r, b = td.textbbox((0, 0), line, font=base_font)
+                w, h = r - l, b - t
+            else:
+                mask = base_font.getmask(line)
+                w, h = mask.size
+            line_sizes.append((w, h))
+        return base_font, line_sizes
+
+    angle_rad = math.radians(angle % 360)
+    cos_a = abs(math.cos(angle_rad))
+    sin_a = abs(math.sin(angle_rad))
+
+    probe_size = 256
+    _, probe_sizes = measure(probe_size)
+    probe_w = max((w for w, h in probe_sizes), default=0)
+    probe_h = sum(h for _, h in probe_sizes) * 1.3
+    probe_rot = max(probe_w * cos_a + probe_h * sin_a, probe_w * sin_a + probe_h * cos_a, 1)
+    base_font_size = max(64, min(int(probe_size * render_size / probe_rot), MAX_FONT))
+    base_font, line_sizes = measure(base_font_size)
 
     max_w = max((w for w, h in line_sizes), default=0)
     ascent, descent = base_font.getmetrics()
@@ -168,72 +196,765 @@ def create_watermark_layer(image_size, cache_key_obj):
             new_layer.paste(text_layer, (0, 0))
             text_layer = new_layer
 
-    # compute rotated footprint using analytic bounding-box estimate (avoids an extra rotate)
-    angle_rad = math.radians(angle % 360)
-    cos_a = abs(math.cos(angle_rad))
-    sin_a = abs(math.sin(angle_rad))
-    rot_w = text_layer.width * cos_a + text_layer.height * sin_a
-    rot_h = text_layer.width * sin_a + text_layer.height * cos_a
-
-    if rot_w == 0 or rot_h == 0:
-        scale = 1.0
+    # the text is a single color, so only its alpha needs rotating and scaling.
+    # Layers used to be pasted with themselves as the mask, which squares the alpha; keep that look
+    rotated = text_layer.getchannel("A").rotate(angle, expand=True, resample=Image.BICUBIC)
+    mask = rotated.point([round(v * v / 255) for v in range(256)])
+    bbox = mask.getbbox()
+    if bbox:
+        center = ((bbox[0] + bbox[2]) / 2.0, (bbox[1] + bbox[3]) / 2.0)
     else:
-        max_frac = 0.99
-        scale = min((image_size[0] * max_frac) / rot_w, (image_size[1] * max_frac) / rot_h)
-        scale = max(0.01, scale)
+        center = (mask.width / 2.0, mask.height / 2.0)
+    return mask, center
+
+
+# Scaled watermark masks shared by all worker processes, keyed by settings + image size.
+# Each mask is stored as a raw file (a small header and the pixels) in a folder on tmpfs when there
+# is one, and memory-mapped by the workers that need it, so they all read the same pages instead of
+# decoding their own copy. Total size is bounded by evicting the least recently used masks
+class LayerCache:
+    HEADER = struct.Struct("<4i")  # width, height, paste x, paste y
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def create(max_bytes):
+        base = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        return LayerCache(tempfile.mkdtemp(prefix="watermark_cache_", dir=base), max_bytes)
+
+    def path(self, key_obj):
+        key_bytes = json.dumps(key_obj, sort_keys=True).encode("utf-8")
+        return os.path.join(self.directory, hashlib.sha1(key_bytes).hexdigest() + ".raw")
+
+    # Return (mask, paste position) for a key, or None. The mask reads straight from the mapping
+    def get(self, key_obj):
+        path = self.path(key_obj)
+        try:
+            with open(path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # mark as recently used for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        width, height, x, y = self.HEADER.unpack_from(mapping)
+        pixels = memoryview(mapping)[self.HEADER.size:]
+        return Image.frombuffer("L", (width, height), pixels, "raw", "L", 0, 1), (x, y)
+
+    # Store a mask, evicting the least recently used ones to stay under the size limit.
+    # Written under a temporary name and renamed, so other workers never see a partial mask
+    def put(self, key_obj, mask, position):
+        size = self.HEADER.size + mask.width * mask.height
+        if size > self.max_bytes:
+            return
+        self.evict(self.max_bytes - size)
+        path = self.path(key_obj)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(self.HEADER.pack(mask.width, mask.height, *position))
+                f.write(mask.tobytes())
+            os.replace(tmp_path, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+
+    def evict(self, max_bytes):
+        try:
+            with os.scandir(self.directory) as entries:
+                files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in entries if entry.name.endswith(".raw")]
+        except OSError:
+            return
+        used = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if used <= max_bytes:
+                break
+            # masks still mapped by a worker stay readable after removal (except on Windows,
+            # where removing them fails and they're kept)
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                used -= size
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# The rendered watermarks (by render size) and the mask cache, shared by every image of the run.
+# Workers get the canonical one and the cache from the main process (see init_worker), and render
+# the watermark on first use of a render size they don't have
+_RENDERS = {}
+_RENDERS_LOCK = threading.Lock()
+_LAYER_CACHE = None
+
+
+def get_canonical_watermark(render_size=CANONICAL_SIZE):
+    # locked so threads sharing this module (Optimize Photos' pipeline) render it only once
+    with _RENDERS_LOCK:
+        if render_size not in _RENDERS:
+            _RENDERS[render_size] = render_watermark(render_size)
+        return _RENDERS[render_size]
 
+
+# Use the watermark rendered by the main process instead of rendering it again in every worker
+def init_worker(canonical, layer_cache):
+    global _LAYER_CACHE
+    if canonical is not None:
+        _RENDERS[CANONICAL_SIZE] = canonical
+    _LAYER_CACHE = layer_cache
+
+
+# Return the rendered watermark used for an image size, the size it is scaled to (fitting 99% of
+# the image) and the position that centers it. Only ever scaled down, unless it is already rendered
+# at MAX_RENDER_SIZE (or at the font size cap)
+def watermark_geometry(image_size):
+    max_frac = 0.99
+    render_size = CANONICAL_SIZE
+    while True:
+        source, (cx, cy) = get_canonical_watermark(render_size)
+        scale = min((image_size[0] * max_frac) / source.width, (image_size[1] * max_frac) / source.height)
+        if scale <= 1.001 or render_size >= MAX_RENDER_SIZE:
+            break
+        render_size = min(render_size * 2, MAX_RENDER_SIZE)
+    scale = max(0.01, scale)
+
+    size = source.size
     if abs(scale - 1.0) > 0.001:
-        new_w = max(1, int(text_layer.width * scale))
-        new_h = max(1, int(text_layer.height * scale))
-        text_layer = text_layer.resize((new_w, new_h), resample=RESAMPLE)
+        size = (max(1, int(source.width * scale)), max(1, int(source.height * scale)))
+        cx *= size[0] / source.width
+        cy *= size[1] / source.height
+    return source, size, (int(image_size[0] / 2.0 - cx), int(image_size[1] / 2.0 - cy))
 
-    rotated = text_layer.rotate(angle, expand=True)
-    bbox = rotated.getbbox()
-    if bbox:
-        cx = (bbox[0] + bbox[2]) / 2.0
-        cy = (bbox[1] + bbox[3]) / 2.0
+
+# Return rows [top, bottom) of a rendered watermark scaled to size, without scaling the other rows
+def scale_watermark_rows(source, size, top, bottom):
+    if size == source.size:
+        return source.crop((0, top, size[0], bottom))
+    ratio = source.height / size[1]
+    return source.resize((size[0], bottom - top), resample=RESAMPLE,
+                         box=(0, top * ratio, source.width, bottom * ratio))
+
+
+# Return the watermark mask for an image size and the position that centers it,
+# from the shared cache when another image had that size
+def get_watermark_mask(image_size, cache_key_obj):
+    if _LAYER_CACHE is not None:
+        cached = _LAYER_CACHE.get(cache_key_obj)
+        if cached is not None:
+            return cached
+
+    source, size, position = watermark_geometry(image_size)
+    # rotation commutes with uniform scaling, so only the (much cheaper) resize depends on the image size
+    mask = source
+    if size != source.size:
+        mask = source.resize(size, resample=RESAMPLE, reducing_gap=2.0)
+
+    if _LAYER_CACHE is not None:
+        _LAYER_CACHE.put(cache_key_obj, mask, position)
+    return mask, position
+
+
+# Blend the watermark mask into an image (RGB or RGBA) in place, only touching the pixels under it
+def apply_watermark(image, mask, position):
+    x, y = position
+    left, top = max(0, x), max(0, y)
+    right, bottom = min(image.width, x + mask.width), min(image.height, y + mask.height)
+    if right <= left or bottom <= top:
+        return
+    region_mask = mask.crop((left - x, top - y, right - x, bottom - y))
+    if image.mode == "RGBA":
+        # blend over translucent pixels the way alpha_composite does
+        patch = Image.new("RGBA", region_mask.size, font_color[:3] + (0,))
+        patch.putalpha(region_mask)
+        image.alpha_composite(patch, (left, top))
     else:
-        cx = rotated.width / 2.0
-        cy = rotated.height / 2.0
-    paste_x = int(image_size[0] / 2.0 - cx)
-    paste_y = int(image_size[1] / 2.0 - cy)
-    watermark.paste(rotated, (paste_x, paste_y), rotated)
-
-    # simpler cache save (faster): single save, best-effort
-    if cache_path:
+        # over opaque pixels, alpha compositing is a masked paste of the text color
+        image.paste(font_color[:3], (left, top, right, bottom), region_mask)
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\x0a'
+# PNG color types that can be streamed (at 8 bits per sample, not interlaced) and their modes
+PNG_STREAM_MODES = {0: "L", 2: "RGB", 4: "LA", 6: "RGBA"}
+# Chunks that describe pixel values of the source color type, not copied to the output
+PNG_DROPPED_CHUNKS = (b'tRNS', b'bKGD', b'sBIT', b'hIST')
+
+
+# Whether an opened image is a PNG that PngBandReader can stream, judging by its header
+def png_streamable(img):
+    return (img.format == "PNG" and img.mode in PNG_STREAM_MODES.values()
+            and img.tile and img.tile[0][3] == img.mode and not img.info.get("interlace"))
+
+
+# Reads a PNG band by band, without ever holding more than a band of it.
+# The image data is inflated a band at a time, and each band is unfiltered by Pillow's own PNG
+# decoder: the band's rows are decoded as a small image, preceded by the last row of the previous
+# band (which the "up", "average" and "paeth" filters refer to)
+class PngBandReader:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
         try:
-            watermark.save(cache_path)
+            if self.file.read(8) != PNG_SIGNATURE:
+                raise ValueError("not a PNG")
+            _, kind = struct.unpack(">I4s", self.file.read(8))
+            if kind != b'IHDR':
+                raise ValueError("missing PNG header")
+            width, height, depth, color_type, _, _, interlace = struct.unpack(">2I5B", self.file.read(13))
+            self.file.read(4)
+            if depth != 8 or interlace or color_type not in PNG_STREAM_MODES:
+                raise ValueError("only 8-bit, non-interlaced grayscale or RGB(A) PNGs can be streamed")
         except Exception:
-            pass
+            self.file.close()
+            raise
+        self.size = (width, height)
+        self.mode = PNG_STREAM_MODES[color_type]
+        self.stride = width * len(self.mode)
+        # ancillary chunks before the image data (color profile, DPI, text...), to copy to the output
+        self.chunks = []
 
-    return watermark
-# --- End helper ---
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.file.close()
 
-# New worker function for parallel processing (must be module-level for ProcessPoolExecutor)
-def process_image(image_path):
+    # Yield the compressed image data, in pieces of at most 1 MB
+    def _image_data(self):
+        while True:
+            header = self.file.read(8)
+            if len(header) < 8:
+                raise ValueError("truncated PNG")
+            length, kind = struct.unpack(">I4s", header)
+            if kind == b'IEND':
+                return
+            if kind == b'IDAT':
+                while length:
+                    piece = self.file.read(min(length, 1024 * 1024))
+                    if not piece:
+                        raise ValueError("truncated PNG")
+                    length -= len(piece)
+                    yield piece
+            else:
+                data = self.file.read(length)
+                if kind[0:1].islower() and kind not in PNG_DROPPED_CHUNKS:
+                    self.chunks.append((kind, data))
+            self.file.read(4)
+
+    # Yield the image as bands of (at most) rows rows
+    def bands(self, rows):
+        width, height = self.size
+        row_bytes = self.stride + 1
+        inflate = zlib.decompressobj()
+        data = self._image_data()
+        pending = bytearray()
+        previous = bytes(self.stride)
+        top = 0
+        while top < height:
+            n = min(rows, height - top)
+            needed = n * row_bytes
+            while len(pending) < needed:
+                if inflate.unconsumed_tail:
+                    pending += inflate.decompress(inflate.unconsumed_tail, needed - len(pending))
+                    continue
+                piece = next(data, None)
+                if piece is None:
+                    raise ValueError("truncated PNG image data")
+                pending += inflate.decompress(piece, needed - len(pending))
+            filtered = b'\x00' + previous + bytes(pending[:needed])
+            del pending[:needed]
+            band = Image.frombytes(self.mode, (width, n + 1), zlib.compress(filtered, 0), "zip", self.mode)
+            band = band.crop((0, 1, width, n + 1))
+            previous = band.crop((0, n - 1, width, n)).tobytes()
+            yield band
+            top += n
+
+
+# Writes an RGB or RGBA PNG band by band, compressing each band as it comes.
+# Rows are written with the "up" filter (difference with the row above), which suits photos
+class PngBandWriter:
+    def __init__(self, out, size, mode, chunks=()):
+        self.out = out
+        self.size = size
+        self.mode = mode
+        self.deflate = zlib.compressobj(6)
+        self.previous = Image.new(mode, (size[0], 1))
+        out.write(PNG_SIGNATURE)
+        self.chunk(b'IHDR', struct.pack(">2I5B", size[0], size[1], 8, 2 if mode == "RGB" else 6, 0, 0, 0))
+        for kind, data in chunks:
+            self.chunk(kind, data)
+
+    def chunk(self, kind, data):
+        self.out.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, band):
+        width, height = band.size
+        above = Image.new(self.mode, band.size)
+        above.paste(self.previous, (0, 0))
+        above.paste(band.crop((0, 0, width, height - 1)), (0, 1))
+        filtered = ImageChops.subtract_modulo(band, above).tobytes()
+        stride = len(filtered) // height
+        rows = b''.join(b'\x02' + filtered[i:i + stride] for i in range(0, len(filtered), stride))
+        data = self.deflate.compress(rows)
+        if data:
+            self.chunk(b'IDAT', data)
+        self.previous = band.crop((0, height - 1, width, height))
+
+    def close(self):
+        self.chunk(b'IDAT', self.deflate.flush())
+        self.chunk(b'IEND', b'')
+
+
+# Watermark a band of an image that starts at row top (the band is an image of its own)
+def apply_watermark_band(band, top, geometry):
+    source, (mask_w, mask_h), (x, y) = geometry
+    first, last = max(top, y), min(top + band.height, y + mask_h)
+    if first < last:
+        apply_watermark(band, scale_watermark_rows(source, (mask_w, mask_h), first - y, last - y), (x, first - top))
+
+
+# Watermark an image above the tiling threshold into tmp_path, never holding a full-size watermark.
+# PNGs (8-bit, not interlaced) are read, watermarked and written a band at a time, so memory stays
+# the same whatever the image size. Pillow can't decode other formats (JPEG...) in parts, so those
+# are decoded whole, but the watermark is still scaled and blended a band at a time
+def watermark_tiled(image_path, tmp_path, timer):
     try:
-        image = Image.open(image_path).convert("RGBA")
-        watermark = create_watermark_layer((image.width, image.height), {
+        reader = PngBandReader(image_path)
+    except ValueError:
+        reader = None
+
+    if reader is not None:
+        with reader, open(tmp_path, 'wb') as out:
+            mode = reader.mode if reader.mode in ("RGB", "RGBA") else "RGBA"
+            geometry = watermark_geometry(reader.size) if text else None
+            bands = reader.bands(tiling_band_rows)
+            writer = None
+            top = 0
+            while True:
+                with timer.stage('decode'):
+                    band = next(bands, None)
+                    if band is None:
+                        break
+                    if band.mode != mode:
+                        band = band.convert(mode)
+                if geometry:
+                    with timer.stage('composite'):
+                        apply_watermark_band(band, top, geometry)
+                with timer.stage('encode'):
+                    if writer is None:
+                        writer = PngBandWriter(out, reader.size, mode, reader.chunks)
+                    writer.write(band)
+                top += band.height
+            with timer.stage('encode'):
+                writer.close()
+            with timer.stage('write'):
+                out.flush()
+                os.fsync(out.fileno())
+        return
+
+    with timer.stage('decode'):
+        image = load_image(image_path)
+    if text:
+        with timer.stage('composite'):
+            source, (mask_w, mask_h), (x, y) = watermark_geometry(image.size)
+            for top in range(0, mask_h, tiling_band_rows):
+                bottom = min(mask_h, top + tiling_band_rows)
+                apply_watermark(image, scale_watermark_rows(source, (mask_w, mask_h), top, bottom), (x, y + top))
+    with timer.stage('encode'):
+        with open(tmp_path, 'wb') as out:
+            save_image(image, out, os.path.splitext(image_path)[1].lower())
+            out.flush()
+            os.fsync(out.fileno())
+
+
+# --- Timing instrumentation (also used by Optimize Photos and the benchmark harness) ---
+
+# Return the peak resident memory of this process in bytes, or None if it can't be determined
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in KB everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Records the wall and CPU time of each processing stage of one file
+class StageTimer:
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = self.stages.get(name, (0.0, 0.0))
+            self.stages[name] = (wall + time.perf_counter() - wall_start, cpu + time.thread_time() - cpu_start)
+
+    def report(self, **extra):
+        return dict(extra, path=self.path, peak_rss=get_peak_rss(),
+                    stages={name: {'wall': wall, 'cpu': cpu} for name, (wall, cpu) in self.stages.items()})
+
+
+# Stand-in for StageTimer when instrumentation is disabled, so timing costs nothing
+class NullTimer:
+    @staticmethod
+    def stage(name):
+        return contextlib.nullcontext()
+
+    @staticmethod
+    def report(**extra):
+        return None
+
+
+NULL_TIMER = NullTimer()
+
+
+# Nearest-rank percentile of an already sorted list
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+
+# Write the aggregated timing report (p50/p95/max per stage, slowest files) as JSON
+def write_run_report(path, reports, elapsed):
+    stage_times = {}
+    for report in reports:
+        for name, times in report['stages'].items():
+            stage_times.setdefault(name, {'wall': [], 'cpu': []})
+            stage_times[name]['wall'].append(times['wall'])
+            stage_times[name]['cpu'].append(times['cpu'])
+    stages = {}
+    for name, times in stage_times.items():
+        stages[name] = {}
+        for kind, values in times.items():
+            values.sort()
+            stages[name][kind] = {
+                'total': sum(values),
+                'p50': percentile(values, 0.50),
+                'p95': percentile(values, 0.95),
+                'max': values[-1],
+            }
+    slowest = sorted(reports, key=lambda r: sum(t['wall'] for t in r['stages'].values()), reverse=True)[:10]
+    peaks = [r['peak_rss'] for r in reports if r.get('peak_rss')]
+    summary = {
+        'files': len(reports),
+        'elapsed': elapsed,
+        'peak_rss': max(peaks) if peaks else None,
+        'stages': stages,
+        'slowest_files': [{'path': r['path'], 'wall': sum(t['wall'] for t in r['stages'].values())} for r in slowest],
+    }
+    with open(path, 'w') as report_file:
+        json.dump(summary, report_file, indent=2)
+
+
+# Return the SHA-1 hex digest of a file's contents
+def hash_file(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Append a record to the journal. Each record is written with a single small append, so records
+# from different workers never interleave; sync makes sure it's on disk before going on
+def append_journal(record, sync=False):
+    with open(journal_path, 'a') as journal_lines:
+        journal_lines.write(json.dumps(record) + '\n')
+        if sync:
+            journal_lines.flush()
+            os.fsync(journal_lines.fileno())
+
+
+# Load the journal (relative path -> latest record), ignoring a line cut short by a crash
+def load_journal(path):
+    entries = {}
+    try:
+        with open(path, 'r') as journal_lines:
+            for line in journal_lines:
+                try:
+                    record = json.loads(line)
+                    entries[record['path']] = record
+                except (ValueError, KeyError):
+                    pass
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+# Rewrite the journal with only the latest record of each image that still exists, atomically
+def compact_journal(path, entries):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as journal_lines:
+        for rel, record in entries.items():
+            if os.path.exists(os.path.join(folder, rel)):
+                journal_lines.write(json.dumps(record) + '\n')
+    os.replace(tmp_path, path)
+
+
+# Whether an image is the watermarked output recorded in its journal record.
+# An unchanged size and modification time is enough (no read, no decode); otherwise, or when a run
+# stopped between writing an image and recording it as done, the contents are compared by hash
+def is_watermarked(path, record):
+    if record is None:
+        return False
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if record.get('state') == 'done' and st.st_size == record.get('size') and st.st_mtime_ns == record.get('mtime_ns'):
+        return True
+    return hash_file(path) == record['hash']
+
+
+# Drop the images the journal says are already watermarked, counting them in skipped['count']
+def skip_watermarked(paths, journal_entries, skipped):
+    for path in paths:
+        if is_watermarked(path, journal_entries.get(os.path.relpath(path, folder))):
+            skipped['count'] += 1
+        else:
+            yield path
+
+
+# Open and decode an image. RGB and RGBA images are watermarked as they are,
+# anything else (palette, grayscale...) is promoted to RGBA first
+def load_image(image_path):
+    image = Image.open(image_path)
+    image.load()
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    return image
+
+
+# Watermark a decoded image (promoting it to RGBA unless it's RGB or RGBA) and return it.
+# Also used as the "watermark" stage of Optimize Photos' pipeline
+def watermark_image(image):
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    if text:
+        mask, position = get_watermark_mask((image.width, image.height), {
             "w": image.width,
             "h": image.height,
         })
-        result = Image.alpha_composite(image, watermark)
-        extension = os.path.splitext(image_path)[1].lower()
-        if extension in ('.jpg', '.jpeg'):
-            result.convert("RGB").save(image_path, quality=95)
-        else:
-            result.save(image_path)
-        return image_path, True, None
+        apply_watermark(image, mask, position)
+    return image
+
+
+# Encode an image in the format of its file extension
+def save_image(image, out, extension):
+    if extension in ('.jpg', '.jpeg'):
+        (image if image.mode == "RGB" else image.convert("RGB")).save(out, format="JPEG", quality=95)
+    else:
+        image.save(out, format=Image.registered_extensions()[extension])
+
+
+# Move a fully written (and synced) output over the original. Renaming means a crash never leaves
+# a truncated image, and the journal records the output before the rename, so a rerun can tell
+# whether it happened
+def commit_output(image_path, tmp_path, output_hash):
+    if journal_path:
+        record = {'path': os.path.relpath(image_path, folder), 'hash': output_hash}
+        append_journal(dict(record, state='pending'), sync=True)
+    os.replace(tmp_path, image_path)
+    if journal_path:
+        st = os.stat(image_path)
+        append_journal(dict(record, state='done', size=st.st_size, mtime_ns=st.st_mtime_ns))
+
+
+# New worker function for parallel processing (must be module-level for ProcessPoolExecutor)
+# Returns (image path, success, error, timing report or None if instrumentation is disabled)
+def process_image(image_path):
+    timer = StageTimer(image_path) if instrumentation_enabled else NULL_TIMER
+    tmp_path = image_path + ".tmp"
+    try:
+        with Image.open(image_path) as probe:
+            pixels = probe.width * probe.height
+        if tiling_enabled and pixels >= tiling_min_megapixels * 1000000:
+            watermark_tiled(image_path, tmp_path, timer)
+            with timer.stage('write'):
+                commit_output(image_path, tmp_path, hash_file(tmp_path))
+            return image_path, True, None, timer.report(pixels=pixels, tiled=True)
+
+        with timer.stage('decode'):
+            image = load_image(image_path)
+        if text:
+            with timer.stage('watermark'):
+                mask, position = get_watermark_mask((image.width, image.height), {
+                    "w": image.width,
+                    "h": image.height,
+                })
+            with timer.stage('composite'):
+                apply_watermark(image, mask, position)
+        with timer.stage('encode'):
+            buffer = BytesIO()
+            save_image(image, buffer, os.path.splitext(image_path)[1].lower())
+        with timer.stage('write'):
+            data = buffer.getvalue()
+            with open(tmp_path, 'wb') as out:
+                out.write(data)
+                out.flush()
+                os.fsync(out.fileno())
+            commit_output(image_path, tmp_path, hashlib.sha1(data).hexdigest())
+        return image_path, True, None, timer.report(pixels=pixels)
     except Exception as e:
-        return image_path, False, str(e)
+        # don't leave a partial output next to the original
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        return image_path, False, str(e), timer.report(error=str(e))
+
+
+# --- Memory-aware admission of parallel jobs (also used by Optimize Photos) ---
+
+# Return the available physical memory in bytes, or None if it can't be determined
+def get_available_memory():
+    # Linux: MemAvailable accounts for reclaimable page cache, unlike free pages
+    try:
+        with open("/proc/meminfo", 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    # Windows
+    if sys.platform == "win32":
+        try:
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [
+                    ("dwLength", ctypes.c_ulong),
+                    ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong),
+                    ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong),
+                    ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong),
+                    ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+                ]
+
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return status.ullAvailPhys
+        except Exception:
+            pass
+    # Other POSIX systems
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return None
+
+
+# Return the memory budget in bytes for all in-flight images combined, from a memory_budget_mb setting
+def get_memory_budget(budget_mb):
+    if isinstance(budget_mb, (int, float)) and budget_mb > 0:
+        return int(budget_mb * 1024 * 1024)
+    # auto: half of the available memory, leaving room for the rest of the system
+    available = get_available_memory()
+    return available // 2 if available else 2 * 1024 * 1024 * 1024
+
+
+# Estimate the memory needed to watermark an image from its header only (width x height x RGBA)
+def estimate_decoded_bytes(image_path):
+    try:
+        with Image.open(image_path) as img:
+            # streamed images only hold a few bands at a time
+            if tiling_enabled and img.width * img.height >= tiling_min_megapixels * 1000000 and png_streamable(img):
+                return img.width * tiling_band_rows * 4 * DECODE_OVERHEAD * 2
+            return img.width * img.height * 4 * DECODE_OVERHEAD
+    except Exception:
+        # Unreadable images fail fast in the worker, they don't need any budget
+        return 0
+
+
+# Submit fn(task) for every task and yield (task, result) as they complete.
+# A task is only admitted while the estimated memory of all in-flight tasks stays under budget
+# and fewer than max_in_flight tasks are queued. A single task over budget runs on its own.
+def run_with_memory_budget(ex, fn, tasks, cost_fn, budget, max_in_flight):
+    in_flight = {}  # future -> (task, cost)
+    used = 0
+
+    def collect():
+        nonlocal used
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            task, cost = in_flight.pop(future)
+            used -= cost
+            yield task, future.result()
+
+    for task in tasks:
+        cost = cost_fn(task)
+        while in_flight and (len(in_flight) >= max_in_flight or used + cost > budget):
+            yield from collect()
+        in_flight[ex.submit(fn, task)] = (task, cost)
+        used += cost
+    while in_flight:
+        yield from collect()
+
+
+# --- Folder scanning (also used by Optimize Photos and Remove EXIF Data) ---
+
+# Yield the paths of all images (files ending with one of exts) under a folder, walking it with os.scandir,
+# without going into the directories named in exclude (by default the cache directories left by older versions)
+def scan_images(root_folder, exts=IMAGE_EXTS, exclude=LEGACY_CACHE_DIRS):
+    stack = [root_folder]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in exclude:
+                            stack.append(entry.path)
+                    elif entry.name.lower().endswith(exts):
+                        yield entry.path
+        except OSError as e:
+            print(f"{red}Failed to scan {current}: {e}{reset}")
+
+
+# Walk a folder in a background thread, feeding image paths into a bounded queue.
+# Iterating yields paths as soon as they're found, so processing starts while the walk
+# (which can take minutes on network shares) is still running.
+class StreamingScanner:
+    def __init__(self, root_folder, exts=IMAGE_EXTS, exclude=LEGACY_CACHE_DIRS, queue_size=4096):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, args=(root_folder, exts, exclude), daemon=True)
+        self.thread.start()
+
+    def _run(self, root_folder, exts, exclude):
+        try:
+            for path in scan_images(root_folder, exts, exclude):
+                self.queue.put(path)
+        finally:
+            self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            yield path
+
+
+# Count paths as they're pulled from a stream, marking the discovery done once it's exhausted
+def track_discovery(paths, discovery):
+    for path in paths:
+        discovery['found'] += 1
+        yield path
+    discovery['done'] = True
 
 
 # Print a fixed-width progress bar string (no newline).
 # The returned string is exactly PROGRESS_COL_WIDTH characters (not counting color codes),
 # so the caller can write one space and then the file message and the message will
-# always start in the same column.
-def print_progress_bar(current, total, bar_length=BAR_LENGTH):
+# always start in the same column. While files are still being discovered (total_known is
+# False), the total is the number found so far and is shown with a trailing '+'.
+def print_progress_bar(current, total, bar_length=BAR_LENGTH, total_known=True):
     global PROGRESS_COL_WIDTH
     if PROGRESS_COL_WIDTH is None:
         # Fallback to a reasonable width if not computed yet
@@ -246,7 +967,7 @@ def print_progress_bar(current, total, bar_length=BAR_LENGTH):
         filled = int(round(bar_length * frac))
         bar = '#' * filled + '-' * (bar_length - filled)
         percent = int(round(frac * 100.0))
-        visible = f"[{bar}] {current}/{total} ({percent}%)"
+        visible = f"[{bar}] {current}/{total}{'' if total_known else '+'} ({percent}%)"
 
     # Pad/truncate the visible text to PROGRESS_COL_WIDTH (visible length only)
     if len(visible) < PROGRESS_COL_WIDTH:
@@ -257,59 +978,93 @@ def print_progress_bar(current, total, bar_length=BAR_LENGTH):
 
 # --- Main entry: gather images and run in parallel ---
 if __name__ == "__main__":
-    # Collect image files while skipping the cache directory
-    image_paths = []
-    for root, dirs, files in os.walk(folder):
-        if '.watermark_cache' in dirs:
-            dirs.remove('.watermark_cache')
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-                image_paths.append(os.path.join(root, file))
-
-    # Compute progress widths like Optimize Photos does so the message column lines up
-    total_files = len(image_paths)
-    PROGRESS_COL_WIDTH = len(f"[{'#'*BAR_LENGTH}] {total_files}/{total_files} (100%)")
+    # Images already watermarked by an earlier (possibly interrupted) run are skipped
+    journal_entries = {}
+    if journal_path:
+        if not os.path.exists(journal_path) and os.path.exists(LEGACY_JOURNAL_PATH):
+            shutil.move(LEGACY_JOURNAL_PATH, journal_path)
+        journal_entries = load_journal(journal_path)
+        compact_journal(journal_path, journal_entries)
+    skipped = {'count': 0}
+
+    # Collect image files
+    # (streaming mode processes them while the folder is still being walked)
+    if streaming:
+        discovery = {'found': 0, 'done': False}
+        image_paths = track_discovery(skip_watermarked(StreamingScanner(folder), journal_entries, skipped), discovery)
+        # Totals aren't known up front, leave room for up to 7 digit counts
+        PROGRESS_COL_WIDTH = len(f"[{'#'*BAR_LENGTH}] 9999999/9999999+ (100%)")
+        total_label = "streamed"
+    else:
+        image_paths = list(skip_watermarked(scan_images(folder), journal_entries, skipped))
+        discovery = {'found': len(image_paths), 'done': True}
+        # Compute progress widths like Optimize Photos does so the message column lines up
+        PROGRESS_COL_WIDTH = len(f"[{'#'*BAR_LENGTH}] {len(image_paths)}/{len(image_paths)} (100%)")
+        total_label = str(len(image_paths))
     # Decide how many worker processes to use: use cpu_count - 1 (leave one core free), min 1
     cpu = os.cpu_count() or 1
     workers = max(1, cpu - 1)
 
-    print(f"{blue}Starting watermarking process on {total_files} files in {folder} with {workers} workers...{reset}")
+    print(f"{blue}Starting watermarking process on {total_label} files in {folder} with {workers} workers...{reset}")
 
     success = 0
     fail = 0
     processed = 0
 
-    with ProcessPoolExecutor(max_workers=workers) as exe:
-        futures = {exe.submit(process_image, p): p for p in image_paths}
-        for fut in as_completed(futures):
-            img, ok, err = fut.result()
-            # build a relative path for nicer messages
-            try:
-                rel = os.path.relpath(img, folder)
-            except Exception:
-                rel = img
-
-            if ok:
-                success += 1
-                message = f"{green}{rel}{reset}"
-            else:
-                fail += 1
-                message = f"{red}Error processing {rel}: {err}{reset}"
+    # Per-file timing reports (JSONL, one line per file as it completes) and their aggregate (JSON)
+    reports = []
+    report_lines = open(os.path.splitext(instrumentation_report)[0] + ".jsonl", 'w') if instrumentation_enabled else None
+    start_time = time.perf_counter()
 
-            processed += 1
-            # Write progress and message together so message always starts in the same column
-            progress_str = print_progress_bar(processed, total_files)
-            sys.stdout.write('\r' + progress_str + ' ' + message + '\n')
-            sys.stdout.flush()
+    # Render and rotate the watermark once; workers only scale it to each image size,
+    # sharing the scaled masks through the layer cache
+    canonical = get_canonical_watermark() if text else None
+    layer_cache = LayerCache.create(cache_memory_mb * 1024 * 1024)
+
+    # Delete the layer cache (in RAM on Linux) even if processing fails or is interrupted
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(canonical, layer_cache)) as exe:
+            completed = run_with_memory_budget(
+                exe, process_image, image_paths,
+                cost_fn=estimate_decoded_bytes,
+                budget=get_memory_budget(memory_budget_mb),
+                max_in_flight=workers * 2,
+            )
+            for _, (img, ok, err, report) in completed:
+                if report is not None:
+                    reports.append(report)
+                    report_lines.write(json.dumps(report) + '\n')
+
+                # build a relative path for nicer messages
+                try:
+                    rel = os.path.relpath(img, folder)
+                except Exception:
+                    rel = img
+
+                if ok:
+                    success += 1
+                    message = f"{green}{rel}{reset}"
+                else:
+                    fail += 1
+                    message = f"{red}Error processing {rel}: {err}{reset}"
+
+                processed += 1
+                # Write progress and message together so message always starts in the same column
+                progress_str = print_progress_bar(processed, discovery['found'], total_known=discovery['done'])
+                sys.stdout.write('\r' + progress_str + ' ' + message + '\n')
+                sys.stdout.flush()
+    finally:
+        layer_cache.close()
+
+    if report_lines is not None:
+        report_lines.close()
+        write_run_report(instrumentation_report, reports, time.perf_counter() - start_time)
 
     # Move to next line after progress bar
     sys.stdout.write("\n")
 
-    # Delete cache directory after processing all images
-    if cache_dir:
-        try:
-            shutil.rmtree(cache_dir)
-        except Exception as e:
-            print(f"{red}Failed to delete watermark cache folder {cache_dir}: {e}{reset}")
-
     print(f"{blue}Successfully watermarked {success} images ({fail} failures){reset}")
+    if skipped['count']:
+        print(f"{blue}Skipped {skipped['count']} images that were already watermarked{reset}")
+    if instrumentation_enabled:
+        print(f"{blue}Timing report written to {instrumentation_report}{reset}")